@@ -31,6 +31,7 @@
 import re
 import os
 import stat
+import time
 import argparse as ap
 
 
@@ -83,6 +84,10 @@ def find_keywords( data, limit ):
    This function finds Python keywords that require indentation
    following them. It returns dictionaries marking the start and
    end blocks.
+
+   The data is read once, keeping a stack of the keyword blocks that are
+   still open. Each line that isn't blank or a comment closes every open
+   block indented at least as far as it is.
    """
 
    # These are the keywords in Python that require indentation
@@ -96,41 +101,50 @@ def find_keywords( data, limit ):
    # Stack dict to hold closing indices.
    closures = {}
 
-   # Find key words ( line number and ending line ).
+   # Stack of open blocks as ( line number, indentation, key word ). The
+   # indentation always increases towards the top.
+   blocks = []
+
+   def close_blocks( closed, close_idx ):
+     # Outer blocks first, so their braces are stacked outside inner ones.
+     for start, spaces, key_word in reversed( closed ):
+
+       # Note: This count will include blank lines preceding the closing
+       #       indentation.
+       if close_idx - start >= limit:
+
+         # If the gap is large enough, store an opening and closing brace set.
+         openings[start] = "%s# %s {" %( " "*spaces, key_word)
+         if close_idx not in closures:
+           closures[close_idx] = []
+         closures[close_idx].append( "%s# } %s "  % ( " "*spaces, key_word))
+
    for index in range(0, len(data)):
 
      line = data[index]
 
-     # Tokenize the line to check for key words.
-     tokens = line.split()
+     # Only the first token is needed to check for key words.
+     tokens = line.split( None, 1 )
 
-     # Disregard all lines that don't have a keyword.
-     if not tokens:
+     # Ignore blank lines and comments.
+     if (not tokens) or tokens[0][0] == '#':
        continue
 
-     # Found a key word, so grab it's index.
-     if tokens[0] in key_words:
-
-       # Since keyword was found, save opening brace.
-       # Also figure out when to close.
-       spaces = ws_count( line )
-       close_idx = find_closure( index+1, spaces, data )
+     # This line closes every block indented at least as far as it is. The
+     # closing brace is written BEFORE it.
+     spaces = ws_count( line )
+     closed = []
+     while blocks and blocks[-1][1] >= spaces:
+       closed.append( blocks.pop() )
+     if closed:
+       close_blocks( closed, index - 1 )
 
-       # The brace closing brace should be written BEFORE the line on
-       # which indentation matches the start.
-       close_idx -= 1
-
-       # Note: This count will include blank lines preceding the closing
-       #       indentation.
-       if close_idx - index >= limit:
+     # Found a key word, so open a block.
+     if tokens[0] in key_words:
+       blocks.append( (index, spaces, tokens[0]) )
 
-         # If the gap is large enough, store an opening and closing brace set.
-         openings[index] = "%s# %s {" %( " "*spaces, tokens[0])
-         if close_idx not in closures:
-           closures[close_idx] = []
-           closures[close_idx].append( "%s# } %s "  % ( " "*spaces, tokens[0]))
-         else:
-           closures[close_idx].append( "%s# } %s "  % ( " "*spaces, tokens[0]))
+   # EOF reached, closure is forced.
+   close_blocks( blocks[::-1], len(data) - 1 )
 
    return openings, closures
 
@@ -161,40 +175,47 @@ def add_braces( file_data, open_lines, close_lines ):
    return new_data
 
 
-def find_closure( start, spaces, data ):
+def ws_count( line ):
   """
-  This function finds the first line that has matching or less indentation
-  to the block starting at START.
+  Returns the count of leading whitespace on a line.
   """
+  return len( line ) - len( line.lstrip(' ') )
 
-  for index in range( start, len(data)):
-
-    line = data[index]
 
-    # Ignore blank lines and comments.
-    tokens = line.split()
-    if (not tokens) or tokens[0][0] == '#' :
-      continue
+def generate_code( lines, depth=50 ):
+  """
+  Returns LINES lines of Python made of keyword blocks nested up to DEPTH
+  deep, all inside one class, so every block is open for a long stretch.
+  """
+  key_words = ['if x:', 'for x in y:', 'while x:', 'try:', 'def f():']
+  data = ["class Generated:"]
 
-    # Find the first line to at least match indentation.
-    if ws_count( line ) <= spaces:
-      return index
+  while len(data) < lines:
+    for level in range(1, depth + 1):
+      indent = "    " * level
+      data.append( indent + key_words[level % len(key_words)] )
+      data.append( indent + "    # Step %d" % level )
+      data.append( indent + "    x = %d" % level )
+      data.append( "" )
 
-  # EOF reached, closure is forced.
-  return index+1
+  return data[:lines]
 
 
-def ws_count( line ):
+def benchmark( lines=100000, limit=15 ):
   """
-  Returns the count of leading whitespace on a line.
+  Times find_keywords() and add_braces() on generated files of up to LINES
+  lines and prints the time per line, which stays flat as the size grows.
   """
-  count = 0
 
-  for char in line:
-   if char == ' ': 
-     count += 1
-   else:
-     return count
+  print "%8s %10s %10s" % ("Lines", "Seconds", "us/line")
+  for size in (lines // 4, lines // 2, lines):
+    data = generate_code( size )
+    start = time.time()
+    open_lines, close_stacks = find_keywords( data, limit )
+    add_braces( data, open_lines, close_stacks )
+    elapsed = time.time() - start
+
+    print "%8d %10.3f %10.2f" % (size, elapsed, elapsed * 1e6 / size)
 
 
 if __name__ == "__main__":
@@ -209,8 +230,15 @@ if __name__ == "__main__":
   parser.add_argument('-l', '--limit', type=int, help=limitStr)
   parser.add_argument('-p', '--prefix',
                        help="Optional prefix to add to file names")
-  parser.add_argument('files', nargs='+', help='Files to be processed')
+  parser.add_argument('-b', '--benchmark', action='store_true',
+                       help="Time brace placement on generated files")
+  parser.add_argument('files', nargs='*', help='Files to be processed')
   args = parser.parse_args()
 
+  if args.benchmark:
+    benchmark( limit=args.limit or 15 )
+  elif not args.files:
+    parser.error( "no files to process" )
+
   for file_name in args.files:
     main( file_name, args )
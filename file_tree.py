@@ -29,6 +29,7 @@
 # Exit Codes:
 # 1 - No root directory specified
 # 2 - Root directory could not be found
+# 3 - Snapshot given to --diff could not be read
 #
 # @Revision:
 # $Id: $
@@ -37,6 +38,631 @@
 import os
 import sys
 import argparse
+import gzip
+import json
+import sqlite3
+import struct
+from array import array
+from multiprocessing.pool import ThreadPool
+
+# scandir() is built in from Python 3.5, older versions may have the
+# 'scandir' package installed. Without either, fall back to listdir().
+try:
+  from os import scandir
+except ImportError:
+  try:
+    from scandir import scandir
+  except ImportError:
+    scandir = None
+
+# Snapshots are gzipped: a header line, then one record per folder holding
+# its inode, mtime and the bytes in its files, followed by its path
+# relative to the root of the walk.
+SNAPSHOT_HEADER = "file_tree snapshot 1\n"
+SNAPSHOT_RECORD = struct.Struct("<QdQH")
+
+# With --jobs, how many of the folders the walk visits next are listed ahead
+# of it, per thread.
+LOOKAHEAD_PER_JOB = 4
+
+# Per-folder totals for --du are cached here between runs.
+CACHE_FILE = os.path.join( os.path.expanduser('~'), '.cache', 'file_tree.db' )
+
+# --du fills folders by the bytes below them: one color per factor of ten
+# from 1 MB up, white below that.
+HEAT_COLORS = ["white", "lightyellow", "yellow", "orange", "orangered", "red"]
+
+# Every node written has one of these kinds. Binary graphs store the index.
+KINDS = ("root", "folder", "summary", "added", "modified", "removed")
+
+# Binary graphs start with BINARY_MAGIC and the node and edge counts. Then
+# come little-endian uint64 arrays, each starting 8-byte aligned so they
+# can be memory-mapped: the CSR offsets (one per node, plus one), the edge
+# targets, and the folder, file and byte counts of each node (0 where not
+# known). Next is one byte per node for its KINDS index, padded to 8 bytes,
+# then the offsets of each name (one per node, plus one) and the names.
+BINARY_MAGIC = "FTREE\x001\x00"
+BINARY_HEADER = struct.Struct("<8sQQ")
+
+#
+# scan_dir: Lists the subdirectories of a directory and totals its files.
+#{
+def scan_dir( path, sizes=False ):
+  """
+  Returns the full paths of the directories in PATH sorted by name, the
+  number of other entries in PATH and, if SIZES is set, their total size in
+  bytes. Sorting keeps node IDs and output order independent of the order
+  the filesystem lists them. With scandir() the type of each child comes
+  from the listing itself, so only SIZES needs a stat per file.
+  """
+  dirs = []
+  files = 0
+  total = 0
+  if scandir is None:
+    for child in os.listdir(path):
+      child_path = os.path.join(path, child)
+      if os.path.isdir( child_path ):
+        dirs.append( child_path )
+        continue
+      files += 1
+      if sizes:
+        try:
+          total += os.lstat( child_path ).st_size
+        except OSError:
+          pass
+    return sorted(dirs), files, total
+
+  for entry in scandir(path):
+    if entry.is_dir():
+      dirs.append( entry.path )
+      continue
+    files += 1
+    if sizes:
+      try:
+        total += entry.stat( follow_symlinks=False ).st_size
+      except OSError:
+        pass
+  return sorted(dirs), files, total
+#}
+# End of scan_dir()
+#
+
+#
+# summarize: Totals the folders, files and bytes below a set of folders.
+#{
+def summarize( paths, snapshot=None, cache=None ):
+  """
+  Walks the trees rooted at each folder in PATHS and returns the number of
+  folders, files and bytes in them. Folders that can't be listed still
+  count, but nothing below them does. Each folder listed is added to
+  SNAPSHOT if one is given, and CACHE is used as by scan_cached().
+  """
+  dirs = 0
+  files = 0
+  total = 0
+  stack = list(paths)
+  while stack:
+    current = stack.pop()
+    dirs += 1
+    try:
+      children, count, size = scan_cached( current, cache )
+    except OSError as err:
+      print "Could not list directory: %s (%s)" % (current, err.strerror)
+      continue
+    files += count
+    total += size
+    if snapshot:
+      snapshot.add( current, size )
+    stack.extend( children )
+  return dirs, files, total
+#}
+# End of summarize()
+#
+
+#
+# format_size: Formats a byte count for a node label.
+#{
+def format_size( size ):
+  """
+  Returns SIZE in bytes as a short string using binary units, e.g. '1.5 MB'.
+  """
+  for unit in ["B", "KB", "MB", "GB", "TB"]:
+    if size < 1024 or unit == "TB":
+      break
+    size /= 1024.0
+  if unit == "B":
+    return "%d B" % size
+  return "%.1f %s" % (size, unit)
+#}
+# End of format_size()
+#
+
+#
+# SizeCache: Persistent per-folder totals for --du.
+#{
+class SizeCache( object ):
+  """
+  Stores the subfolder names, file count and file bytes of each folder in
+  an SQLite database, keyed by device and inode. An entry only applies
+  while the folder's mtime is unchanged, so a folder that gained or lost
+  entries is listed again.
+  """
+  def __init__( self, db_path, commit_every=1000 ):
+    db_dir = os.path.dirname(db_path)
+    if db_dir and not os.path.isdir(db_dir):
+      os.makedirs(db_dir)
+
+    self.conn = sqlite3.connect(db_path)
+    self.conn.execute("CREATE TABLE IF NOT EXISTS dirs ("
+                      " dev INTEGER, ino INTEGER, mtime REAL,"
+                      " files INTEGER, bytes INTEGER, subdirs TEXT,"
+                      " PRIMARY KEY (dev, ino))")
+    self.conn.text_factory = str
+    self.commit_every = commit_every
+    self.pending = 0
+
+  def get( self, path ):
+    """
+    Returns the cached scan_dir() result for PATH, or None if there is
+    none or the folder has changed since.
+    """
+    st = os.stat(path)
+    row = self.conn.execute("SELECT mtime, files, bytes, subdirs FROM dirs"
+                            " WHERE dev=? AND ino=?",
+                            (st.st_dev, st.st_ino)).fetchone()
+    if not row or row[0] != st.st_mtime:
+      return None
+    # Names can't hold a '/', so it separates them.
+    names = row[3].split('/') if row[3] else []
+    return [os.path.join(path, name) for name in names], row[1], row[2]
+
+  def put( self, path, children, files, size ):
+    """
+    Stores the scan_dir() result CHILDREN, FILES and SIZE for PATH.
+    """
+    st = os.stat(path)
+    names = '/'.join( os.path.split(child)[-1] for child in children )
+    self.conn.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?, ?, ?)",
+                      (st.st_dev, st.st_ino, st.st_mtime, files, size, names))
+
+    self.pending += 1
+    if self.pending >= self.commit_every:
+      self.conn.commit()
+      self.pending = 0
+
+  def close( self ):
+    self.conn.commit()
+    self.conn.close()
+#}
+# End of SizeCache
+#
+
+#
+# scan_cached: Lists a directory with sizes, reusing cached results.
+#{
+def scan_cached( path, cache=None ):
+  """
+  Returns scan_dir(PATH, sizes=True), taken from CACHE if PATH hasn't
+  changed since it was cached, and stored in CACHE otherwise.
+  """
+  if cache:
+    result = cache.get( path )
+    if result:
+      return result
+  result = scan_dir( path, sizes=True )
+  if cache:
+    cache.put( path, *result )
+  return result
+#}
+# End of scan_cached()
+#
+
+#
+# heat_color: Picks the fill color for a folder holding a number of bytes.
+#{
+def heat_color( size ):
+  """
+  Returns the HEAT_COLORS entry for SIZE bytes.
+  """
+  index = 0
+  limit = 1024 * 1024
+  while size >= limit and index < len(HEAT_COLORS) - 1:
+    index += 1
+    limit *= 10
+  return HEAT_COLORS[index]
+#}
+# End of heat_color()
+#
+
+#
+# Snapshot: Records the folders seen by a walk for a later --diff.
+#{
+class Snapshot( object ):
+  """
+  Writes one record per folder to FILE_NAME. Paths are stored relative to
+  ROOT so a snapshot still applies if the tree is mounted elsewhere. The
+  records go to a temporary file that only replaces FILE_NAME on close(), so
+  a run that fails part way leaves the previous snapshot in place.
+  """
+  def __init__( self, file_name, root ):
+    self.root = root
+    self.file_name = file_name
+    self.temp_name = file_name + ".tmp"
+    self.out_file = gzip.open( self.temp_name, 'wb' )
+    self.out_file.write( SNAPSHOT_HEADER )
+
+  def add( self, path, size, st=None ):
+    """
+    Records the folder at PATH holding SIZE bytes of files. ST is its stat
+    result, if the caller already has one.
+    """
+    try:
+      if st is None:
+        st = os.stat( path )
+    except OSError:
+      return
+    rel = path[len(self.root) + 1:]
+    self.out_file.write( SNAPSHOT_RECORD.pack(st.st_ino, st.st_mtime, size,
+                                              len(rel)) + rel )
+
+  def close( self ):
+    self.out_file.close()
+    os.rename( self.temp_name, self.file_name )
+#}
+# End of Snapshot
+#
+
+#
+# load_snapshot: Reads a snapshot written by Snapshot.
+#{
+def load_snapshot( file_name ):
+  """
+  Returns a dict mapping each relative folder path in the snapshot at
+  FILE_NAME to its (inode, mtime, size), and a dict mapping each folder to
+  the sorted list of its subfolders.
+  """
+  in_file = gzip.open( file_name, 'rb' )
+  data = in_file.read()
+  in_file.close()
+  if not data.startswith( SNAPSHOT_HEADER ):
+    raise ValueError( "not a file_tree snapshot" )
+
+  entries = {}
+  children = {}
+  offset = len(SNAPSHOT_HEADER)
+  while offset < len(data):
+    inode, mtime, size, length = SNAPSHOT_RECORD.unpack_from( data, offset )
+    offset += SNAPSHOT_RECORD.size
+    rel = data[offset:offset + length]
+    offset += length
+    entries[rel] = (inode, mtime, size)
+    if rel:
+      children.setdefault( os.path.dirname(rel), [] ).append( rel )
+  for subdirs in children.values():
+    subdirs.sort()
+  return entries, children
+#}
+# End of load_snapshot()
+#
+
+#
+# DotWriter: Writes the graph for the 'dot' utility.
+#{
+class DotWriter( object ):
+  """
+  Writes nodes and edges to FILE_NAME as a 'dot' digraph, drawing folders
+  as SHAPE.
+  """
+  colors = {"root": "blue", "folder": "black", "summary": "gray",
+            "added": "green", "modified": "orange", "removed": "red"}
+
+  def __init__( self, file_name, shape ):
+    self.shape = shape
+    self.out_file = open( file_name, 'w' )
+    #
+    # Write the opening graph information
+    #
+    self.out_file.write( "digraph G\n{\n")
+
+  def node( self, uid, name, kind, dirs=None, files=None, size=None,
+            old_size=None ):
+    label = name.replace('"', '\\"')
+    style = ""
+    if kind == "summary":
+      style = ",style=dashed"
+      label += "\\n%d dirs, %d files, %s" % (dirs, files, format_size(size))
+    elif kind == "removed":
+      style = ",style=dashed"
+      label += "\\n%d dirs removed" % dirs
+    elif kind == "modified":
+      label += "\\n%s -> %s" % (format_size(old_size), format_size(size))
+    elif kind != "added" and size is not None:
+      style = ",style=filled,fillcolor=" + heat_color(size)
+      label += "\\n%s, %d files" % (format_size(size), files)
+
+    self.out_file.write( "node_%d[shape=%s,color=%s%s,label=\"%s\"];\n" %
+                         (uid, self.shape, self.colors[kind], style, label) )
+
+  def edge( self, parent, child ):
+    self.out_file.write( "node_%d->node_%d;\n" % (parent, child) )
+
+  def close( self ):
+    #
+    # Write the closing graph information
+    #
+    self.out_file.write("}\n")
+    self.out_file.close()
+#}
+# End of DotWriter
+#
+
+#
+# json_name: Makes a folder name safe for json.dumps().
+#{
+def json_name( name ):
+  """
+  Returns NAME ready for json.dumps(). Names that aren't valid UTF-8 are
+  decoded as Latin-1 instead, so one odd name can't stop the walk.
+  """
+  if isinstance( name, bytes ):
+    try:
+      return name.decode('utf-8')
+    except UnicodeDecodeError:
+      return name.decode('latin-1')
+  return name
+#}
+# End of json_name()
+#
+
+#
+# JsonWriter: Writes the graph as JSON Lines.
+#{
+class JsonWriter( object ):
+  """
+  Writes each node and edge to FILE_NAME as a line of JSON as soon as it's
+  found, so other tools can follow the walk while it runs. Counts that
+  aren't known for a node are left out of its record.
+  """
+  def __init__( self, file_name ):
+    self.out_file = open( file_name, 'w' )
+
+  def node( self, uid, name, kind, dirs=None, files=None, size=None,
+            old_size=None ):
+    record = {'type': 'node', 'id': uid, 'name': json_name(name),
+              'kind': kind}
+    for key, value in (('dirs', dirs), ('files', files), ('bytes', size),
+                       ('old_bytes', old_size)):
+      if value is not None:
+        record[key] = value
+    self.out_file.write( json.dumps(record, sort_keys=True) + '\n' )
+
+  def edge( self, parent, child ):
+    record = {'type': 'edge', 'from': parent, 'to': child}
+    self.out_file.write( json.dumps(record, sort_keys=True) + '\n' )
+
+  def close( self ):
+    self.out_file.close()
+#}
+# End of JsonWriter
+#
+
+#
+# CsrWriter: Writes the graph as a compressed sparse row adjacency list.
+#{
+class CsrWriter( object ):
+  """
+  Collects the graph and, once it's complete, writes it to FILE_NAME as
+  text: a line with the node and edge counts, a line of nodes + 1 offsets,
+  a line of edge targets, then each node's name on a line of its own with
+  backslashes and newlines escaped. The children of node N are the targets
+  from offset N up to offset N + 1, in name order.
+  """
+  def __init__( self, file_name ):
+    self.file_name = file_name
+    self.names = []
+    self.parents = array('L')
+    self.children = array('L')
+
+  def node( self, uid, name, kind, dirs=None, files=None, size=None,
+            old_size=None ):
+    # With --du nodes arrive once their subtree is done, not in ID order.
+    if uid >= len(self.names):
+      self.names.extend( [None] * (uid + 1 - len(self.names)) )
+    self.names[uid] = name
+
+  def edge( self, parent, child ):
+    self.parents.append( parent )
+    self.children.append( child )
+
+  def csr( self ):
+    """
+    Returns the offsets and targets of the collected edges, with each
+    node's children kept in the order they were found.
+    """
+    offsets = array('L', [0]) * (len(self.names) + 1)
+    for parent in self.parents:
+      offsets[parent + 1] += 1
+    for index in range(len(self.names)):
+      offsets[index + 1] += offsets[index]
+
+    targets = array('L', [0]) * len(self.children)
+    slots = offsets[:-1]
+    for parent, child in zip( self.parents, self.children ):
+      targets[slots[parent]] = child
+      slots[parent] += 1
+    return offsets, targets
+
+  def close( self ):
+    offsets, targets = self.csr()
+    out_file = open( self.file_name, 'w' )
+    out_file.write( "%d %d\n" % (len(self.names), len(targets)) )
+    out_file.write( " ".join(str(offset) for offset in offsets) + "\n" )
+    out_file.write( " ".join(str(target) for target in targets) + "\n" )
+    for name in self.names:
+      out_file.write( name.replace('\\', '\\\\').replace('\n', '\\n') + "\n" )
+    out_file.close()
+#}
+# End of CsrWriter
+#
+
+#
+# BinaryWriter: Writes the graph in a compact memory-mappable form.
+#{
+class BinaryWriter( CsrWriter ):
+  """
+  Collects the graph like CsrWriter and writes it to FILE_NAME in the
+  binary layout described at BINARY_MAGIC.
+  """
+  def __init__( self, file_name ):
+    CsrWriter.__init__( self, file_name )
+    self.counts = {}
+
+  def node( self, uid, name, kind, dirs=None, files=None, size=None,
+            old_size=None ):
+    CsrWriter.node( self, uid, name, kind )
+    self.counts[uid] = (dirs or 0, files or 0, size or 0, KINDS.index(kind))
+
+  def close( self ):
+    offsets, targets = self.csr()
+    nodes = len(self.names)
+    counts = [self.counts[uid] for uid in range(nodes)]
+
+    name_offsets = [0]
+    for name in self.names:
+      name_offsets.append( name_offsets[-1] + len(name) )
+
+    def write_array( values ):
+      out_file.write( struct.pack("<%dQ" % len(values), *values) )
+
+    out_file = open( self.file_name, 'wb' )
+    out_file.write( BINARY_HEADER.pack(BINARY_MAGIC, nodes, len(targets)) )
+    write_array( offsets )
+    write_array( targets )
+    for column in range(3):
+      write_array( [count[column] for count in counts] )
+    kinds = struct.pack( "<%dB" % nodes, *[count[3] for count in counts] )
+    out_file.write( kinds + "\0" * (-nodes % 8) )
+    write_array( name_offsets )
+    out_file.write( "".join(self.names) )
+    out_file.close()
+#}
+# End of BinaryWriter
+#
+
+#
+# Writers: Passes the walk on to several writers.
+#{
+class Writers( list ):
+  """
+  A list of writers that is used as one, so a single walk can produce the
+  graph in several formats at once.
+  """
+  def node( self, *args, **kwargs ):
+    for writer in self:
+      writer.node( *args, **kwargs )
+
+  def edge( self, parent, child ):
+    for writer in self:
+      writer.edge( parent, child )
+
+  def close( self ):
+    for writer in self:
+      writer.close()
+#}
+# End of Writers
+#
+
+#
+# diff_tree: Writes the folders that changed since a snapshot.
+#{
+def diff_tree( root_dir, prev, writer, snapshot=None ):
+  """
+  Walks ROOT_DIR against PREV, a snapshot as returned by load_snapshot(),
+  and passes WRITER the folders added, modified and removed since, along
+  with the unchanged folders above them that connect them to the root.
+  Only folders whose inode or mtime changed are listed; the subfolders of
+  the rest come from PREV. The new state is added to SNAPSHOT if one is
+  given.
+  """
+  entries, old_children = prev
+
+  #
+  # Nothing is written until a change is found. CHAIN holds the folders
+  # from the root down to the current one as [name, uid] pairs, and any
+  # not yet written are written with the change so it hangs off the root.
+  #
+  chain = []
+  ids = [0]
+
+  def write_node( depth, kind, **counts ):
+    for index in range(depth + 1):
+      if chain[index][1] is None:
+        uid = ids[0]
+        ids[0] += 1
+        chain[index][1] = uid
+        if index == depth:
+          writer.node( uid, chain[index][0], kind, **counts )
+        elif index == 0:
+          writer.node( uid, chain[index][0], "root" )
+        else:
+          writer.node( uid, chain[index][0], "folder" )
+        if index > 0:
+          writer.edge( chain[index - 1][1], uid )
+
+  def subtree_size( rel ):
+    count = 0
+    stack = [rel]
+    while stack:
+      count += 1
+      stack.extend( old_children.get(stack.pop(), []) )
+    return count
+
+  unvisited_nodes = [("", 0)]
+  while unvisited_nodes:
+    rel, depth = unvisited_nodes.pop()
+    if rel:
+      current = os.path.join( root_dir, rel )
+    else:
+      current = root_dir
+    try:
+      st = os.stat( current )
+    except OSError as err:
+      print "Could not stat directory: %s (%s)" % (current, err.strerror)
+      continue
+
+    del chain[depth:]
+    chain.append( [os.path.split(current)[-1], None] )
+
+    old = entries.get( rel )
+    if old and old[0] == st.st_ino and old[1] == st.st_mtime:
+      subdirs = old_children.get( rel, [] )
+      if snapshot:
+        snapshot.add( current, old[2], st )
+      unvisited_nodes.extend( (path, depth + 1) for path in reversed(subdirs) )
+      continue
+
+    try:
+      children, files, size = scan_dir( current, sizes=True )
+    except OSError as err:
+      print "Could not list directory: %s (%s)" % (current, err.strerror)
+      continue
+    if snapshot:
+      snapshot.add( current, size, st )
+    subdirs = [path[len(root_dir) + 1:] for path in children]
+
+    if old is None:
+      write_node( depth, "added", files=files, size=size )
+    else:
+      write_node( depth, "modified", files=files, size=size, old_size=old[2] )
+      for path in sorted( set(old_children.get(rel, [])) - set(subdirs) ):
+        chain.append( [os.path.split(path)[-1], None] )
+        write_node( depth + 1, "removed", dirs=subtree_size(path) )
+        chain.pop()
+
+    unvisited_nodes.extend( (path, depth + 1) for path in reversed(subdirs) )
+#}
+# End of diff_tree()
+#
 
 #
 # main: The main entry point for the file tree browser.
@@ -60,10 +686,12 @@ def main( args ):
   if not os.path.isdir(root_dir):
     print "Could not find directory: " + root_dir
     exit(2)
-  # If no output is specified, assume ROOT + ".dot"
+  # If no output is specified, assume ROOT + ".dot", unless only other
+  # formats were asked for.
+  file_name = None
   if args.output:
     file_name = args.output
-  else:
+  elif not (args.jsonl or args.csr or args.binary):
     file_name = root_dir + ".dot"
 
   # Default shape will be 'folder'
@@ -80,65 +708,202 @@ def main( args ):
     shape = "folder"
     print "Using default shape: " + shape
 
-  unvisited_nodes = [root_dir]
-  visited_nodes = []
-  number = 0
-  node_to_name = {}
-  name_to_node = {}
+  # Read the previous snapshot first, --snapshot may be about to replace it.
+  prev = None
+  if args.diff:
+    try:
+      prev = load_snapshot( args.diff )
+    except (IOError, ValueError, struct.error) as err:
+      print "Could not read snapshot: %s (%s)" % (args.diff, err)
+      exit(3)
+
+  writer = Writers()
+  if file_name:
+    writer.append( DotWriter(file_name, shape) )
+  if args.jsonl:
+    writer.append( JsonWriter(args.jsonl) )
+  if args.csr:
+    writer.append( CsrWriter(args.csr) )
+  if args.binary:
+    writer.append( BinaryWriter(args.binary) )
+
+  snapshot = None
+  if args.snapshot:
+    snapshot = Snapshot( args.snapshot, root_dir )
+
+  if prev:
+    diff_tree( root_dir, prev, writer, snapshot )
+    if snapshot:
+      snapshot.close()
+    writer.close()
+    return
+
+  #
+  # Walk the tree depth first, passing each node and edge to the writers as
+  # soon as it's found so nothing but the stack of unvisited folders is
+  # kept in memory, unless a writer needs the whole graph.
+  # Node IDs are handed out when a folder is discovered so the edge to it
+  # can be written straight away.
+  #
+  # With more than one job, the next few folders the walk will visit are
+  # listed on a thread pool ahead of it, and each listing is collected when
+  # the walk reaches its folder. Slow listings overlap, but the output is
+  # the same as a single job. Only a window of folders is listed ahead, so a
+  # folder with a million subfolders doesn't queue and hold a listing for
+  # each of them at once.
+  #
+  # With --du every listing needs sizes, and unchanged folders come from
+  # the cache. The cache is only used from this thread, so it's checked
+  # before a listing is queued.
+  du = args.du
+  cache = None
+  if du and not args.no_cache:
+    cache = SizeCache( args.cache or CACHE_FILE )
+  sizes = bool(snapshot) or du
+
+  pool = None
+  if args.jobs and args.jobs > 1:
+    pool = ThreadPool(args.jobs)
+
+  def cached( path ):
+    if cache:
+      try:
+        return cache.get( path )
+      except OSError:
+        pass
+    return None
+
+  lookahead = 0
+  if pool:
+    lookahead = args.jobs * LOOKAHEAD_PER_JOB
+  in_flight = [0]
+
+  def prefetch():
+    # Entries are [path, uid, listing, depth], the next one to visit last.
+    index = len(unvisited_nodes) - 1
+    while( index >= max(len(unvisited_nodes) - lookahead, 0) and
+           in_flight[0] < lookahead ):
+      entry = unvisited_nodes[index]
+      if entry[2] is None and not summarized( entry[3] ):
+        entry[2] = cached( entry[0] ) or pool.apply_async( scan_dir,
+                                                           (entry[0], sizes) )
+        in_flight[0] += 1
+      index -= 1
+
+  #
+  # Subtrees too deep or too wide to draw are rolled up into one summary
+  # node as the walk reaches them. The folders below are still listed once
+  # each to total them, but none of them become nodes.
+  #
+  def write_summary( uid, name, paths ):
+    dirs, files, total = summarize( paths, snapshot, cache )
+    writer.node( uid, name, "summary", dirs=dirs, files=files, size=total )
+    return files, total
+
+  #
+  # With --du a folder's node is only written once everything below it has
+  # been walked, so its label can carry the totals. OPEN_DIRS holds the
+  # folders from the root down to the current one as [uid, name, kind,
+  # depth, files, bytes], and each one adds its totals to its parent's as
+  # it's closed.
+  #
+  open_dirs = []
+
+  def close_dirs( depth ):
+    while open_dirs and open_dirs[-1][3] >= depth:
+      uid, name, kind, _, files, total = open_dirs.pop()
+      writer.node( uid, name, kind, files=files, size=total )
+      if open_dirs:
+        open_dirs[-1][4] += files
+        open_dirs[-1][5] += total
+
+  def add_totals( files, total ):
+    if open_dirs:
+      open_dirs[-1][4] += files
+      open_dirs[-1][5] += total
+
+  max_depth = args.max_depth
+  threshold = args.collapse_threshold
+
+  # Folders at the depth limit stand in for everything below them, and
+  # summarize() lists them rather than the walk.
+  def summarized( depth ):
+    return max_depth is not None and depth >= max_depth and depth > 0
+
+  unvisited_nodes = [[root_dir, 0, None, 0]]
+  number = 1
 
   while( len(unvisited_nodes) > 0 ):
-     current = unvisited_nodes.pop()
-     uid = "node_" + str(number)
-     number += 1
+     prefetch()
+     current, uid, pending, depth = unvisited_nodes.pop()
+     if pending is not None:
+       in_flight[0] -= 1
+     close_dirs( depth )
 
-     # Create nodes in the tree.
-     node = (uid, current)
+     name = os.path.split(current)[-1]
 
-     children = []
-     for child in os.listdir(current):
-        path = os.path.join(current, child)
-        if os.path.isdir( path ):
-           children.append(path)
-           node_to_name[uid] = children
-           unvisited_nodes.append( path )
-     visited_nodes.append(node)
+     if summarized( depth ):
+       add_totals( *write_summary( uid, name, [current] ) )
+       continue
 
-  for node in visited_nodes:
-     name_to_node[node[1]] = node[0]
+     if current == root_dir:
+       kind = "root"
+     else:
+       kind = "folder"
 
-  out_file = open( file_name, 'w' )
-#
-# Write the opening graph information
-#
-  
-  out_file.write( "digraph G\n{\n")
-  for name in name_to_node.keys():
-    #
-    #  Create drawing rules for nodes
-    #
-    node = name_to_node[name]
-    if name == root_dir:
-      outline = "blue"
-    else:
-      outline = "black"
-    
-    label = os.path.split(name)[-1]
-    out_file.write( node + '[shape=' + shape + 
-                           ',color=' + outline +
-                           ',label="' + label + '"];\n')
+     if du:
+       open_dirs.append( [uid, name, kind, depth, 0, 0] )
+     else:
+       writer.node( uid, name, kind )
 
-  for node in node_to_name:
-    current = node_to_name[node]
-    for each in current:
-      #
-      # Create rules for edges here
-      #
-      out_file.write( node + "->" + name_to_node[each] + ";\n")
-#
-# Write the closing graph information
-#
-  out_file.write("}\n")
-  out_file.close()
+     try:
+       if pending is None:
+         pending = cached( current )
+       if isinstance( pending, tuple ):
+         children, files, size = pending
+       else:
+         if pending:
+           children, files, size = pending.get()
+         else:
+           children, files, size = scan_dir( current, sizes )
+         if cache:
+           cache.put( current, children, files, size )
+       if snapshot:
+         snapshot.add( current, size )
+       add_totals( files, size )
+     except OSError as err:
+       print "Could not list directory: %s (%s)" % (current, err.strerror)
+       children = []
+
+     # Too many folders to draw: one summary node takes their place.
+     if threshold is not None and len(children) > threshold:
+       child = number
+       number += 1
+       writer.edge( uid, child )
+       add_totals( *write_summary( child, "%d folders" % len(children),
+                                   children ) )
+       continue
+
+     found = []
+     for path in children:
+        child = number
+        number += 1
+        writer.edge( uid, child )
+
+        found.append( [path, child, None, depth + 1] )
+
+     # Push in reverse so folders are visited in name order.
+     unvisited_nodes.extend( reversed(found) )
+
+  close_dirs( 0 )
+
+  if pool:
+    pool.terminate()
+  if snapshot:
+    snapshot.close()
+  if cache:
+    cache.close()
+  writer.close()
 
 #}
 # End of main()
@@ -158,7 +923,28 @@ if __name__ == "__main__":
   parser = argparse.ArgumentParser(prog=progName ,description=descStr)
   parser.add_argument('-r','--root', help='Folder from which to start the search.')
   parser.add_argument('-o','--output', help='Name of the output file.')
+  parser.add_argument('--jsonl', metavar='FILE',
+                      help='Also write the nodes and edges as JSON Lines.')
+  parser.add_argument('--csr', metavar='FILE',
+                      help='Also write the graph as a CSR adjacency list.')
+  parser.add_argument('--binary', metavar='FILE',
+                      help='Also write the graph in a memory-mappable binary form.')
   parser.add_argument('-s','--shape', help='Shape used to represent the folders.')
+  parser.add_argument('-j','--jobs', type=int, help='Number of folders to list in parallel.')
+  parser.add_argument('--max-depth', type=int,
+                      help='Summarize folders deeper than this in one node each.')
+  parser.add_argument('--collapse-threshold', type=int,
+                      help='Summarize the children of folders with more subfolders than this.')
+  parser.add_argument('--du', action='store_true',
+                      help='Label and color each folder by the size of everything below it.')
+  parser.add_argument('--cache',
+                      help='Folder size cache for --du (default: %s)' % CACHE_FILE)
+  parser.add_argument('--no-cache', action='store_true',
+                      help='Do not read or update the folder size cache.')
+  parser.add_argument('--snapshot',
+                      help='Save the folders seen by this run to a snapshot file.')
+  parser.add_argument('--diff', metavar='PREV',
+                      help='Only draw folders changed since the snapshot PREV.')
   args = parser.parse_args()
 
 
@@ -23,23 +23,272 @@
 #
 # @Project:  Python Tools
 #
-# @Purpose: Finds duplicate files in the given file tree (based on MD5 hash).
+# @Purpose: Finds duplicate files in the given file tree (based on checksums).
 #           Optionally creates a script to remove the duplicates.
 #
 ################################################################################
 import os
+import re
+import csv
+import sys
+import json
+import time
+import mmap
+import zlib
+import errno
+import shutil
 import signal
+import struct
 import os.path as op
+import socket
+import sqlite3
+import heapq
+import threading
 import hashlib as hl
 import argparse as ap
+from array import array
+from binascii import hexlify, unhexlify
+from multiprocessing.pool import ThreadPool
+
+try:
+  import cPickle as pickle
+except ImportError:
+  import pickle
+
+try:
+  import xxhash
+except ImportError:
+  xxhash = None
+
+# fcntl is only needed to make reflinks, and doesn't exist on Windows.
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+# posix_fadvise() is only in the os module from Python 3.3, older versions
+# call it from the C library to drop files from the page cache.
+posix_fadvise = getattr(os, 'posix_fadvise', None)
+POSIX_FADV_DONTNEED = getattr(os, 'POSIX_FADV_DONTNEED', 4)
+if posix_fadvise is None and sys.platform.startswith('linux'):
+  try:
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL( ctypes.util.find_library('c'), use_errno=True )
+    posix_fadvise = libc.posix_fadvise64
+    posix_fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64,
+                              ctypes.c_int]
+  except (ImportError, OSError, AttributeError):
+    posix_fadvise = None
+
+# PIL (Pillow) is only needed to find similar, rather than identical, images.
+try:
+  from PIL import Image
+except ImportError:
+  Image = None
+
+# Default number of bytes read at a time when hashing a whole file.
+BLOCK_SIZE = 1024 * 1024
+
+# Bytes hashed at each offset of a --sample fingerprint.
+SAMPLE_SIZE = 64 * 1024
+
+# Files smaller than this are read into a buffer even when mmap is requested.
+MMAP_THRESHOLD = 64 * 1024 * 1024
+
+# Default location of the persistent checksum cache.
+CACHE_FILE = op.join(op.expanduser('~'), '.cache', 'find_dups.db')
+
+# Default location of the scan checkpoint and seconds between saves.
+CHECKPOINT_FILE = op.join(op.expanduser('~'), '.cache', 'find_dups.state')
+CHECKPOINT_INTERVAL = 60
+
+# Default journal of files removed by --delete, and files per deletion batch.
+JOURNAL_FILE = 'rmjournal.txt'
+DELETE_BATCH = 500
+
+# First field of the header line of a shard manifest.
+MANIFEST_HEADER = '# find_dups manifest'
+
+# Checkpoint of the running scan, saved by the SIGINT handler.
+active_checkpoint = None
+
+
+class Stats(object):
+  """
+  Counters for the running scan, shared with the hashing threads. Counters
+  are created on first use, e.g. 'files_walked', 'bytes_hashed', 'cache_hits'
+  and '<stage>_hashed' for each hashing stage.
+  """
+
+  def __init__( self ):
+    self.lock = threading.Lock()
+    self.start = time.time()
+    self.counts = {}
+
+  def add( self, name, amount=1 ):
+    with self.lock:
+      self.counts[name] = self.counts.get(name, 0) + amount
+
+  def summary( self ):
+    """
+    Returns a dictionary of every counter plus the elapsed seconds and the
+    overall hashing rates.
+    """
+
+    with self.lock:
+      summary = dict(self.counts)
+
+    elapsed = max(time.time() - self.start, 1e-9)
+    hashed = sum( summary[name] for name in summary
+                                if name.endswith('_hashed')
+                                and name != 'bytes_hashed' )
+    summary['elapsed'] = round(elapsed, 3)
+    summary['mb_per_sec'] = round(summary.get('bytes_hashed', 0) / elapsed
+                                  / 1048576.0, 2)
+    summary['files_per_sec'] = round(hashed / elapsed, 2)
+    return summary
+
+  def line( self ):
+    """
+    Returns the counters formatted as a single progress line.
+    """
+
+    summary = self.summary()
+    fields = ['%.1fs' % summary.pop('elapsed')]
+    fields.append( '%.1f MB/s' % summary.pop('mb_per_sec') )
+    fields.append( '%.1f files/s' % summary.pop('files_per_sec') )
+    for name in sorted(summary):
+      fields.append( '%s %d' % (name.replace('_', ' '), summary[name]) )
+    return ' | '.join(fields)
+
+  def report_every( self, interval, out=sys.stderr ):
+    """
+    Writes a progress line to OUT every INTERVAL seconds from a background
+    thread. Returns an Event that stops the reports when set.
+    """
+
+    stop = threading.Event()
+
+    def report():
+      while not stop.wait(interval):
+        out.write( self.line() + '\n' )
+        out.flush()
+
+    thread = threading.Thread(target=report)
+    thread.daemon = True
+    thread.start()
+    return stop
+
+
+# Counters of the running scan.
+scan_stats = Stats()
+
+# ioctl request to share the extents of one file with another (linux/fs.h).
+FICLONE = 0x40049409
+
+# ioctl request to map a file's logical blocks to physical extents.
+FS_IOC_FIEMAP = 0xC020660B
+
+
+class CrcHash(object):
+  """
+  Non-cryptographic 64-bit checksum made from zlib's CRC-32 and Adler-32. Used
+  as the fast prefilter when xxhash isn't installed.
+  """
+
+  def __init__( self ):
+    self.crc = 0
+    self.adler = 1
+
+  def update( self, data ):
+    # zlib won't take a memoryview or bytearray on Python 2, and str() of a
+    # memoryview there is its repr rather than its contents.
+    if isinstance(data, memoryview):
+      data = data.tobytes()
+    elif not isinstance(data, bytes):
+      data = bytes(data)
+    self.crc = zlib.crc32(data, self.crc)
+    self.adler = zlib.adler32(data, self.adler)
+
+  def hexdigest( self ):
+    return '%08x%08x' % (self.crc & 0xffffffff, self.adler & 0xffffffff)
+
+
+# Checksum algorithms by name. Matches found with the non-cryptographic ones
+# should be confirmed with --verify.
+ALGORITHMS = {'md5': hl.md5, 'sha1': hl.sha1, 'crc': CrcHash}
+if hasattr(hl, 'blake2b'):
+  ALGORITHMS['blake2b'] = hl.blake2b
+if xxhash:
+  ALGORITHMS['xxh64'] = xxhash.xxh64
+  if hasattr(xxhash, 'xxh3_128'):
+    ALGORITHMS['xxh128'] = xxhash.xxh3_128
+
+# Default algorithms for the head/tail prefilter and for confirming matches.
+FAST_ALGO = 'xxh64' if xxhash else 'crc'
+STRONG_ALGO = 'blake2b' if 'blake2b' in ALGORITHMS else 'sha1'
+
+
+class FileIndex(object):
+  """
+  Compact list of file paths. Each directory name is stored once in a table
+  and each file as the id of its directory plus its own name, so deep trees
+  don't repeat every parent in every path. Names are interned, so the
+  IMG_0001.JPG found in hundreds of folders is only stored once. Indexing and
+  iterating give back full paths in the order the files were added.
+  """
+
+  __slots__ = ('dirs', 'dir_id_of', 'dir_ids', 'names')
+
+  def __init__( self ):
+    self.dirs = []
+    self.dir_id_of = {}
+    self.dir_ids = array('I')
+    self.names = []
+
+  def add( self, dir_name, file_name ):
+    if dir_name not in self.dir_id_of:
+      self.dir_id_of[dir_name] = len(self.dirs)
+      self.dirs.append(dir_name)
+
+    self.dir_ids.append( self.dir_id_of[dir_name] )
+    self.names.append( intern(file_name) )
+
+  def __len__( self ):
+    return len(self.names)
+
+  def __getitem__( self, index ):
+    return op.join( self.dirs[self.dir_ids[index]], self.names[index] )
+
+  def __iter__( self ):
+    index = 0
+    while index < len(self.names):
+      yield self[index]
+      index += 1
+
+  def footprint( self ):
+    """
+    Returns an estimate of the bytes used to hold the index.
+    """
+
+    total = sys.getsizeof(self.dirs) + sys.getsizeof(self.dir_id_of)
+    total += sum( sys.getsizeof(dir_name) for dir_name in self.dirs )
+    total += sys.getsizeof(self.dir_ids) + sys.getsizeof(self.names)
+
+    # Interned names are shared, count each one once.
+    names = dict( (id(file_name), file_name) for file_name in self.names )
+    total += sum( sys.getsizeof(file_name) for file_name in names.values() )
+    return total
 
 
 def find_files(path, kind):
   """
   Finds files of type KIND recursively from the directory rooted at PATH.
+  Returns them as a FileIndex in walk order.
   """
 
-  files = []
+  files = FileIndex()
 
   # Create lists of extentions for picture or movie types instead of
   # checking the magic number of every file in the list.
@@ -56,21 +305,1093 @@ def find_files(path, kind):
     for file_name in each[2]:
       tokens = file_name.split(".")
       if tokens[-1].lower() in exts:
-        files.append( op.join(dir_name, file_name) )
+        files.add( dir_name, file_name )
+        scan_stats.add('files_walked')
   return files
 
 
-def gen_checksum( target ):
+def get_synchsafe_int( data ):
+  """
+  Returns the integer held in the synchsafe bytes DATA, 7 bits to a byte as in
+  ID3v2 tag headers (the same decoding as get_int_from_synch() in pyd3v.py).
+  """
+
+  value = 0
+  for byte in bytearray(data):
+    value = (value << 7) | (byte & 0x7f)
+
+  return value
+
+
+def audio_region( target ):
+  """
+  Returns the (start, end) byte range of the audio frames of the song TARGET,
+  leaving out a leading ID3v2 tag and any trailing APEv2 and ID3v1 tags.
+  """
+
+  start, end = 0, op.getsize( target )
+
+  in_file = open(target, 'rb')
+  try:
+    header = in_file.read(10)
+    if len(header) == 10 and header[:3] == b'ID3':
+      start = 10 + get_synchsafe_int( header[6:10] )
+
+      # ID3v2.4 tags may be followed by a 10 byte footer.
+      if bytearray(header)[5] & 0x10:
+        start += 10
+
+    # An ID3v1 tag is always the last 128 bytes of the file.
+    if end - start >= 128:
+      in_file.seek(end - 128)
+      if in_file.read(3) == b'TAG':
+        end -= 128
+
+    # An APEv2 tag ends in a 32 byte footer holding its size, which doesn't
+    # count the optional 32 byte header.
+    if end - start >= 32:
+      in_file.seek(end - 32)
+      footer = in_file.read(32)
+      if footer[:8] == b'APETAGEX':
+        tag_size = struct.unpack('<I', footer[12:16])[0]
+        flags = struct.unpack('<I', footer[20:24])[0]
+        end -= tag_size
+        if flags & 0x80000000:
+          end -= 32
+  finally:
+    in_file.close()
+
+  return start, max(start, end)
+
+
+def group_by_size( file_list, region=None ):
+  """
+  Groups the files in FILE_LIST by their size in bytes. Returns a dictionary
+  of size to an array of the positions of those files in FILE_LIST, in walk
+  order. Only the first name found for each inode is kept, hardlinks to it
+  already share its data and aren't duplicates. REGION, if given, maps a file
+  name to the (start, end) byte range that's compared instead of the whole
+  file.
+  """
+
+  size_dict = {}
+  inodes = set()
+
+  index = -1
+  for file_name in file_list:
+    index += 1
+    try:
+      st = os.stat( file_name )
+    except OSError:
+      # File vanished or can't be read, it can't be a duplicate.
+      continue
+
+    # Only files with more than one link can share an inode with another.
+    if st.st_nlink > 1:
+      if (st.st_dev, st.st_ino) in inodes:
+        continue
+      inodes.add( (st.st_dev, st.st_ino) )
+
+    size = st.st_size
+    if region:
+      try:
+        start, end = region( file_name )
+      except (IOError, OSError):
+        continue
+      size = end - start
+
+    if size not in size_dict:
+      size_dict[size] = array('I')
+    size_dict[size].append(index)
+
+  return size_dict
+
+
+def gen_partial_checksum( target, span=4096, algo=FAST_ALGO, region=None ):
+  """
+  Generates an ALGO hash of the first and last SPAN bytes of the TARGET, or
+  of the (start, end) byte range REGION of it if given.
+  """
+
+  chksum = ALGORITHMS[algo]()
+  if region:
+    start, end = region
+  else:
+    start, end = 0, op.getsize( target )
+  size = end - start
+
+  in_file = open(target, 'rb')
+  in_file.seek(start)
+  data = in_file.read(min(span, size))
+
+  # Small files were already read in full by the first read.
+  if size > span:
+    in_file.seek( start + max(span, size - span) )
+    data += in_file.read(min(span, size - span))
+  in_file.close()
+
+  scan_stats.add('bytes_hashed', len(data))
+  chksum.update( data )
+
+  return chksum.hexdigest()
+
+
+def find_candidates( groups, hasher ):
+  """
+  Splits each group of file names in GROUPS using the checksums produced by
+  HASHER and returns only the groups that still have more than one member.
+  HASHER is given a list of file names and yields (file name, checksum) pairs,
+  with None for files that couldn't be read.
+  """
+
+  candidates = []
+
+  # Checksums only need to match within the group a file came from.
+  group_of = {}
+  for index in range(len(groups)):
+    for file_name in groups[index]:
+      group_of[file_name] = index
+
+  sub_groups = {}
+  for file_name, chksum in hasher( list(group_of) ):
+    if chksum is None:
+      continue
+
+    key = (group_of[file_name], chksum)
+    if key not in sub_groups:
+      sub_groups[key] = []
+    sub_groups[key].append(file_name)
+
+  for key in sub_groups:
+    if len(sub_groups[key]) > 1:
+      candidates.append( sub_groups[key] )
+
+  return candidates
+
+
+def confirm_groups( candidates, hasher ):
+  """
+  Yields (checksum, file names) for each set of two or more identical files
+  in the CANDIDATES groups, as soon as every file of its group is hashed.
+  HASHER is given a list of file names and yields (file name, checksum) pairs,
+  with None for files that couldn't be read.
+  """
+
+  group_of = {}
+  remaining = []
+  for index in range(len(candidates)):
+    remaining.append( len(candidates[index]) )
+    for file_name in candidates[index]:
+      group_of[file_name] = index
+
+  sub_groups = {}
+  for file_name, chksum in hasher( list(group_of) ):
+    index = group_of[file_name]
+    if chksum is not None:
+      if index not in sub_groups:
+        sub_groups[index] = {}
+      if chksum not in sub_groups[index]:
+        sub_groups[index][chksum] = []
+      sub_groups[index][chksum].append(file_name)
+
+    remaining[index] -= 1
+    if remaining[index] == 0:
+      found = sub_groups.pop(index, {})
+      for chksum in found:
+        if len(found[chksum]) > 1:
+          yield chksum, found[chksum]
+
+
+def hash_files( file_names, checksum, column, algo, cache=None, jobs=1,
+                device_jobs=0 ):
+  """
+  Yields (file name, checksum) pairs for FILE_NAMES as each checksum becomes
+  available. Checksums are taken from the COLUMN of CACHE for algorithm ALGO
+  where possible and otherwise computed with CHECKSUM across JOBS worker
+  threads, with no more than DEVICE_JOBS files read at once from any one
+  device (0 for no limit). Files that can't be read are yielded with None in
+  place of the checksum.
+  """
+
+  pending = []
+  keys = {}
+
+  # Cache lookups stay on this thread, the SQLite connection isn't shared.
+  for file_name in file_names:
+    try:
+      if cache:
+        key, chksum = cache.get( file_name, column, algo )
+      else:
+        key, chksum = stat_key( os.stat(file_name) ), None
+    except OSError:
+      yield file_name, None
+      continue
+
+    if chksum:
+      scan_stats.add('cache_hits')
+      yield file_name, chksum
+    else:
+      keys[file_name] = key
+      pending.append(file_name)
+
+  # One semaphore per device keeps spinning disks from seeking between reads.
+  limits = {}
+  if device_jobs > 0:
+    for file_name in pending:
+      dev = keys[file_name][0]
+      if dev not in limits:
+        limits[dev] = threading.BoundedSemaphore(device_jobs)
+
+  def work( file_name ):
+    limit = limits.get( keys[file_name][0] )
+    if limit:
+      limit.acquire()
+    try:
+      return file_name, checksum( file_name )
+    except (IOError, OSError):
+      return file_name, None
+    finally:
+      if limit:
+        limit.release()
+
+  if jobs > 1:
+    pool = ThreadPool(jobs)
+    results = pool.imap_unordered( work, pending )
+  else:
+    pool = None
+    results = (work(file_name) for file_name in pending)
+
+  try:
+    for file_name, chksum in results:
+      if chksum is not None:
+        scan_stats.add('%s_hashed' % column)
+        if cache:
+          cache.put( keys[file_name], file_name, column, algo, chksum )
+      yield file_name, chksum
+  finally:
+    if pool:
+      pool.terminate()
+
+
+def gen_checksum( target, block_size=BLOCK_SIZE, algo='md5', region=None ):
+  """
+  Generates an ALGO hash of the TARGET, or of the (start, end) byte range
+  REGION of it if given. The file is read BLOCK_SIZE bytes at a time into a
+  single reused buffer, so memory use doesn't depend on file size.
+  """
+
+  chksum = ALGORITHMS[algo]()
+  buf = bytearray(block_size)
+  view = memoryview(buf)
+
+  in_file = open(target, 'rb')
+  if region:
+    in_file.seek( region[0] )
+    remaining = region[1] - region[0]
+  else:
+    remaining = None
+
+  while remaining is None or remaining > 0:
+    if remaining is None:
+      count = in_file.readinto(buf)
+    else:
+      count = in_file.readinto( view[:min(block_size, remaining)] )
+      remaining -= count
+    if not count:
+      break
+    chksum.update( view[:count] )
+    scan_stats.add('bytes_hashed', count)
+  in_file.close()
+
+  return chksum.hexdigest()
+
+
+def gen_sample_checksum( target, blocks, sample_size=SAMPLE_SIZE,
+                         algo='md5' ):
+  """
+  Generates an ALGO hash of the size of the TARGET and of BLOCKS samples of
+  SAMPLE_SIZE bytes taken from its head, its tail and evenly spaced offsets in
+  between. Files too small to sample are hashed in full.
+  """
+
+  chksum = ALGORITHMS[algo]()
+  size = op.getsize( target )
+  chksum.update( ('%d:' % size).encode('ascii') )
+
+  in_file = open(target, 'rb')
+  if size <= blocks * sample_size:
+    offsets, sample_size = [0], size
+  elif blocks < 2:
+    offsets = [0]
+  else:
+    offsets = [i * (size - sample_size) // (blocks - 1) for i in range(blocks)]
+
+  for offset in offsets:
+    in_file.seek(offset)
+    data = in_file.read(sample_size)
+    scan_stats.add('bytes_hashed', len(data))
+    chksum.update( data )
+  in_file.close()
+
+  return chksum.hexdigest()
+
+
+def stat_key( st ):
+  """
+  Returns the (device, inode, size, mtime in ns) tuple identifying the
+  contents of a file from its stat result ST.
+  """
+
+  mtime = getattr(st, 'st_mtime_ns', None)
+  if mtime is None:
+    mtime = int(st.st_mtime * 1000000000)
+
+  return (st.st_dev, st.st_ino, st.st_size, mtime)
+
+
+class HashCache(object):
+  """
+  Persistent store of partial and full checksums kept in an SQLite database.
+  Entries are keyed by device, inode, size and modification time, so a file
+  that has changed since it was cached is simply hashed again. Each entry
+  also keeps the absolute path it was last seen at, for prune().
+  """
+
+  columns = ('partial', 'full')
+
+  def __init__( self, db_path, commit_every=1000 ):
+    db_dir = op.dirname(db_path)
+    if db_dir and not op.isdir(db_dir):
+      os.makedirs(db_dir)
+
+    self.conn = sqlite3.connect(db_path)
+    # Paths are byte strings that needn't be valid UTF-8.
+    self.conn.text_factory = str
+    self.conn.execute("CREATE TABLE IF NOT EXISTS hashes ("
+                      " dev INTEGER, ino INTEGER, size INTEGER,"
+                      " mtime INTEGER, path TEXT, partial TEXT, full TEXT,"
+                      " PRIMARY KEY (dev, ino, size, mtime))")
+    self.conn.execute("CREATE INDEX IF NOT EXISTS hashes_path"
+                      " ON hashes (path)")
+    self.commit_every = commit_every
+    self.pending = 0
+
+    # Stat keys looked up by this run, these entries are known to be current.
+    self.seen = set()
+
+  def get( self, target, column, algo ):
+    """
+    Returns the stat key of TARGET and its cached ALGO checksum from COLUMN,
+    or None in place of the checksum if it isn't cached.
+    """
+
+    if column not in self.columns:
+      raise ValueError("Unknown checksum column: %s" % column)
+
+    key = stat_key( os.stat(target) )
+    self.seen.add(key)
+    row = self.conn.execute("SELECT %s FROM hashes WHERE dev=? AND ino=?"
+                            " AND size=? AND mtime=?" % column, key).fetchone()
+    # Checksums are stored as 'algo:digest' so a change of --algo is a miss.
+    if row and row[0] and row[0].startswith(algo + ':'):
+      return key, row[0][len(algo) + 1:]
+
+    return key, None
+
+  def put( self, key, target, column, algo, value ):
+    """
+    Stores VALUE as the ALGO checksum in COLUMN for TARGET, identified by the
+    stat KEY.
+    """
+
+    if column not in self.columns:
+      raise ValueError("Unknown checksum column: %s" % column)
+
+    self.conn.execute("INSERT OR IGNORE INTO hashes (dev, ino, size, mtime)"
+                      " VALUES (?, ?, ?, ?)", key)
+    self.conn.execute("UPDATE hashes SET path=?, %s=? WHERE dev=? AND ino=?"
+                      " AND size=? AND mtime=?" % column,
+                      (op.abspath(target), '%s:%s' % (algo, value)) + key)
+
+    self.pending += 1
+    if self.pending >= self.commit_every:
+      self.conn.commit()
+      self.pending = 0
+
+  def prune( self, root ):
+    """
+    Removes entries for files under the directory ROOT that no longer exist
+    or have changed since they were cached. Entries looked up by this run
+    are current and aren't checked again, and entries outside ROOT are left
+    alone, as their tree may just not be mounted. Returns the number of
+    entries removed.
+    """
+
+    # Every path under ROOT sorts between ROOT/ and the next possible name.
+    prefix = op.join( op.abspath(root), '' )
+    end = prefix[:-1] + chr( ord(prefix[-1]) + 1 )
+
+    stale = []
+    rows = self.conn.execute("SELECT dev, ino, size, mtime, path FROM hashes"
+                             " WHERE path >= ? AND path < ?", (prefix, end))
+    for row in rows:
+      if tuple(row[:4]) in self.seen:
+        continue
+
+      try:
+        current = stat_key( os.stat(row[4]) )
+      except (OSError, TypeError):
+        current = None
+
+      if current != tuple(row[:4]):
+        stale.append( tuple(row[:4]) )
+
+    self.conn.executemany("DELETE FROM hashes WHERE dev=? AND ino=? AND size=?"
+                          " AND mtime=?", stale)
+    self.conn.commit()
+    return len(stale)
+
+  def close( self ):
+    self.conn.commit()
+    self.conn.close()
+
+
+def same_contents( first, second, block_size=BLOCK_SIZE, region=None ):
+  """
+  Returns True if the files FIRST and SECOND hold exactly the same bytes.
+  REGION, if given, maps a file name to the (start, end) byte range that's
+  compared instead of the whole file.
+  """
+
+  start_one = start_two = 0
+  remaining = None
+  if region:
+    start_one, end_one = region( first )
+    start_two, end_two = region( second )
+    if end_one - start_one != end_two - start_two:
+      return False
+    remaining = end_one - start_one
+
+  file_one = open(first, 'rb')
+  file_two = open(second, 'rb')
+  file_one.seek(start_one)
+  file_two.seek(start_two)
+
+  try:
+    while True:
+      count = block_size
+      if remaining is not None:
+        count = min(block_size, remaining)
+        remaining -= count
+
+      data_one = file_one.read(count)
+      data_two = file_two.read(count)
+      if data_one != data_two:
+        return False
+      if not data_one:
+        return True
+  finally:
+    file_one.close()
+    file_two.close()
+
+
+def verify_groups( file_dict, method, block_size=BLOCK_SIZE, jobs=1,
+                   device_jobs=0, region=None ):
+  """
+  Confirms each group of matching files in FILE_DICT either by hashing them
+  again with STRONG_ALGO (METHOD 'hash') or by comparing their bytes (METHOD
+  'bytes'), limited to the byte ranges given by REGION if set. Returns a new
+  dictionary in which files that only matched by accident are split into
+  separate groups.
+  """
+
+  verified = {}
+
+  if method == 'hash':
+    strong_of = {}
+    names = [name for key in file_dict if len(file_dict[key]) > 1
+                  for name in file_dict[key]]
+    strong_checksum = lambda name: gen_checksum( name, block_size,
+                                                 STRONG_ALGO,
+                                                 region and region(name) )
+    for file_name, chksum in hash_files( names, strong_checksum, 'full',
+                                         STRONG_ALGO, None, jobs,
+                                         device_jobs ):
+      if chksum is not None:
+        strong_of[file_name] = chksum
+
+  for key in file_dict:
+    if len(file_dict[key]) <= 1:
+      verified[key] = file_dict[key]
+      continue
+
+    # Each new sub-group is represented by its first member.
+    sub_groups = []
+    for file_name in file_dict[key]:
+      for sub_group in sub_groups:
+        try:
+          if method == 'hash':
+            strong = strong_of.get(file_name)
+            match = strong is not None and strong == strong_of.get(sub_group[0])
+          else:
+            match = same_contents( sub_group[0], file_name, block_size,
+                                   region )
+        except (IOError, OSError):
+          match = False
+
+        if match:
+          sub_group.append(file_name)
+          break
+      else:
+        sub_groups.append( [file_name] )
+
+    for index in range(len(sub_groups)):
+      verified['%s:%d' % (key, index)] = sub_groups[index]
+
+  return verified
+
+
+def physical_offset( target ):
+  """
+  Returns the physical byte offset on disk of the first extent of TARGET, as
+  reported by the FIEMAP ioctl, or None where that isn't supported.
+  """
+
+  if fcntl is None:
+    return None
+
+  # struct fiemap asking for a single struct fiemap_extent over the whole file.
+  request = struct.pack('=QQIIII', 0, 0xffffffffffffffff, 0, 0, 1, 0)
+  request += b'\0' * 56
+
+  in_file = open(target, 'rb')
+  try:
+    reply = fcntl.ioctl( in_file.fileno(), FS_IOC_FIEMAP, request )
+  except (IOError, OSError):
+    return None
+  finally:
+    in_file.close()
+
+  if struct.unpack('=I', reply[20:24])[0] == 0:
+    return None
+  return struct.unpack('=Q', reply[40:48])[0]
+
+
+def disk_order( file_names, method='inode' ):
+  """
+  Returns FILE_NAMES sorted into the order they're laid out on each device,
+  so spinning disks read them with as little seeking as possible. METHOD
+  'inode' sorts by inode number and 'extent' by the physical offset of each
+  file's first extent, falling back to the inode where that isn't known.
+  """
+
+  keys = {}
+  for file_name in file_names:
+    try:
+      st = os.stat( file_name )
+    except OSError:
+      # Left for the hasher to report.
+      keys[file_name] = (0, 0, 0)
+      continue
+
+    offset = None
+    if method == 'extent':
+      offset = physical_offset( file_name )
+
+    if offset is None:
+      keys[file_name] = (st.st_dev, 1, st.st_ino)
+    else:
+      keys[file_name] = (st.st_dev, 0, offset)
+
+  return sorted( file_names, key=keys.get )
+
+
+def drop_cached( file_names ):
+  """
+  Asks the kernel to drop FILE_NAMES from the page cache. Returns False if
+  that isn't possible on this platform or the kernel refuses.
+  """
+
+  if posix_fadvise is None:
+    return False
+
+  for file_name in file_names:
+    try:
+      fd = os.open( file_name, os.O_RDONLY )
+    except OSError:
+      continue
+    try:
+      # The C library returns an error number, the os module raises.
+      if posix_fadvise( fd, 0, 0, POSIX_FADV_DONTNEED ):
+        return False
+    except OSError:
+      return False
+    finally:
+      os.close(fd)
+
+  return True
+
+
+def benchmark_schedule( file_names, method, block_size=BLOCK_SIZE ):
+  """
+  Hashes FILE_NAMES once in walk order and once in METHOD disk order and
+  prints the read throughput of each in MB/s. The files are dropped from the
+  page cache before each run. Where that can't be done nothing is timed, as
+  the second run would read from memory.
+  """
+
+  if not drop_cached( file_names ):
+    print "The page cache can't be dropped here, can't compare read orders!"
+    exit(1)
+
+  print "%-8s %10s" % ("Order", "MB/s")
+  for label, names in (('walk', file_names),
+                       (method, disk_order(file_names, method))):
+    drop_cached( names )
+
+    total = 0
+    start = time.time()
+    for file_name in names:
+      try:
+        gen_checksum( file_name, block_size, FAST_ALGO )
+        total += op.getsize( file_name )
+      except (IOError, OSError):
+        continue
+    elapsed = max(time.time() - start, 1e-9)
+
+    print "%-8s %10.1f" % (label, total / elapsed / 1048576.0)
+
+
+def benchmark_memory( file_index ):
   """
-  Generates an MD5 hash of the TARGET.
+  Prints the bytes used per file to track the files in the FileIndex
+  FILE_INDEX, compared with keeping a plain list of full paths. Only the
+  walk is measured, the groups built while hashing still hold full paths
+  and hex digests.
   """
 
-  chksum = hl.md5()
+  count = max(len(file_index), 1)
+
+  paths = list(file_index)
+  path_bytes = sys.getsizeof(paths)
+  path_bytes += sum( sys.getsizeof(file_name) for file_name in paths )
+  paths = None
+
+  print "%-12s %12s %12s" % ("Structure", "Before", "After")
+  print "%-12s %12.1f %12.1f" % ("Paths", path_bytes / float(count),
+                                 file_index.footprint() / float(count))
+
+
+def benchmark_algorithms( size_mb=256, block_size=BLOCK_SIZE ):
+  """
+  Hashes SIZE_MB megabytes of in-memory data with every available algorithm
+  and prints the throughput of each in MB/s.
+  """
+
+  data = os.urandom(block_size)
+  blocks = max(1, size_mb * 1024 * 1024 // block_size)
+
+  print "%-8s %10s" % ("Algo", "MB/s")
+  for algo in sorted(ALGORITHMS):
+    chksum = ALGORITHMS[algo]()
+    start = time.time()
+    for count in range(blocks):
+      chksum.update( data )
+    chksum.hexdigest()
+    elapsed = max(time.time() - start, 1e-9)
+
+    print "%-8s %10.1f" % (algo, blocks * block_size / elapsed / 1048576.0)
+
+
+def gen_mmap_checksum( target, block_size=BLOCK_SIZE, algo='md5' ):
+  """
+  Generates an ALGO hash of the TARGET by mapping it into memory and passing
+  BLOCK_SIZE slices of the mapping to the hasher without copying them. Small
+  files and files that can't be mapped are hashed by gen_checksum() instead.
+  """
+
+  if op.getsize( target ) < MMAP_THRESHOLD:
+    return gen_checksum( target, block_size, algo )
+
+  in_file = open(target, 'rb')
+  try:
+    try:
+      mapping = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (EnvironmentError, ValueError):
+      # Special filesystems (procfs, some FUSE mounts) refuse to be mapped.
+      return gen_checksum( target, block_size, algo )
+
+    try:
+      if hasattr(mapping, 'madvise'):
+        mapping.madvise(mmap.MADV_SEQUENTIAL)
+
+      # Python 2 mappings only offer the old buffer interface.
+      try:
+        view = memoryview(mapping)
+      except TypeError:
+        view = None
+
+      chksum = ALGORITHMS[algo]()
+      for offset in range(0, len(mapping), block_size):
+        if view is not None:
+          chksum.update( view[offset:offset + block_size] )
+        else:
+          chksum.update( buffer(mapping, offset, block_size) )
+      scan_stats.add('bytes_hashed', len(mapping))
+
+      # The mapping can't be closed while a view of it is still alive.
+      if view is not None:
+        view.release()
+    finally:
+      mapping.close()
+  finally:
+    in_file.close()
 
-  chksum.update( open(target, 'r').read() )
   return chksum.hexdigest()
 
 
+def gen_dhash( target, hash_size=8 ):
+  """
+  Generates a perceptual difference hash of the image TARGET. The image is
+  shrunk to a HASH_SIZE+1 by HASH_SIZE grayscale thumbnail and each bit of the
+  result records whether a pixel is brighter than its right-hand neighbour, so
+  re-encoded or resized copies of a picture hash to (nearly) the same value.
+  """
+
+  image = Image.open(target)
+  image = image.convert('L').resize( (hash_size + 1, hash_size) )
+  pixels = list(image.getdata())
+
+  dhash = 0
+  for row in range(hash_size):
+    for col in range(hash_size):
+      left = pixels[row * (hash_size + 1) + col]
+      right = pixels[row * (hash_size + 1) + col + 1]
+      dhash = (dhash << 1) | (left > right)
+
+  return dhash
+
+
+def hamming( first, second ):
+  """
+  Returns the number of bits that differ between the integers FIRST and
+  SECOND.
+  """
+
+  return bin(first ^ second).count('1')
+
+
+class BKTree(object):
+  """
+  Burkhard-Keller tree of integer hashes under the Hamming distance. Searches
+  only descend into children whose edge distance is within the threshold of
+  the query's distance to the node, so lookups avoid comparing every pair.
+  """
+
+  def __init__( self ):
+    # Each node is [hash, items, {distance: child node}].
+    self.root = None
+
+  def add( self, value, item ):
+    """
+    Adds ITEM to the tree under the hash VALUE.
+    """
+
+    if self.root is None:
+      self.root = [value, [item], {}]
+      return
+
+    node = self.root
+    while True:
+      distance = hamming( value, node[0] )
+      if distance == 0:
+        node[1].append(item)
+        return
+
+      if distance not in node[2]:
+        node[2][distance] = [value, [item], {}]
+        return
+      node = node[2][distance]
+
+  def search( self, value, threshold ):
+    """
+    Returns the items of every node whose hash is within THRESHOLD bits of
+    VALUE.
+    """
+
+    found = []
+    if self.root is None:
+      return found
+
+    # Walk with an explicit stack, deep trees would hit the recursion limit.
+    stack = [self.root]
+    while stack:
+      node = stack.pop()
+      distance = hamming( value, node[0] )
+      if distance <= threshold:
+        found.extend( node[1] )
+
+      for edge in node[2]:
+        if distance - threshold <= edge <= distance + threshold:
+          stack.append( node[2][edge] )
+
+    return found
+
+
+def find_similar( file_list, threshold, jobs=1, device_jobs=0 ):
+  """
+  Groups the images in FILE_LIST whose perceptual hashes are within THRESHOLD
+  bits of each other. Returns a dictionary of group name to list of file
+  names, in the same form as the checksum dictionary used for exact matches.
+  """
+
+  file_dict = {}
+  tree = BKTree()
+  dhashes = {}
+
+  # Pillow raises more than IOError on real images, e.g. DecompressionBombError
+  # on huge panoramas or ValueError and SyntaxError on broken files. Skip any
+  # image it can't decode, like a file that can't be read.
+  def image_hash( file_name ):
+    try:
+      return gen_dhash( file_name )
+    except Exception:
+      return None
+
+  for file_name, dhash in hash_files( file_list, image_hash, 'dhash', 'dhash',
+                                      None, jobs, device_jobs ):
+    if dhash is None:
+      continue
+    dhashes[file_name] = dhash
+    tree.add( dhash, file_name )
+
+  # Each image not yet grouped starts a group holding its unclaimed neighbours.
+  grouped = set()
+  for file_name in file_list:
+    if file_name not in dhashes or file_name in grouped:
+      continue
+
+    group = [file_name]
+    grouped.add(file_name)
+    for match in tree.search( dhashes[file_name], threshold ):
+      if match not in grouped:
+        group.append(match)
+        grouped.add(match)
+
+    file_dict['%016x' % dhashes[file_name]] = group
+
+  return file_dict
+
+
+def find_duplicate_dirs( root, file_dict ):
+  """
+  Builds a Merkle hash for every directory under ROOT from the names of all
+  the files and subdirectories it holds, the checksums of the files and the
+  hashes of the subdirectories, using the groups of identical files in
+  FILE_DICT. A directory holding a file that isn't in any group of FILE_DICT
+  (one that wasn't scanned or has no duplicate) or a subdirectory that
+  wasn't hashed can't match any other directory and gets no hash, and
+  neither do its parents. Returns a dictionary of directory hash to list of
+  directories, leaving out directories that sit inside another duplicated
+  directory, as their contents are already reported there.
+  """
+
+  checksum_of = {}
+  for key in file_dict:
+    if len(file_dict[key]) > 1:
+      for file_name in file_dict[key]:
+        checksum_of[file_name] = key
+
+  # List every directory in full, walking the tree the same way find_files()
+  # did so the paths match those in FILE_DICT.
+  walk_order = []
+  entries = {}
+  files_below = {}
+  unique = set()
+  for dir_name, sub_dirs, file_names in os.walk(root):
+    walk_order.append(dir_name)
+    entries[dir_name] = []
+    files_below[dir_name] = len(file_names)
+
+    for name in sub_dirs:
+      entries[dir_name].append( ('d', name, op.join(dir_name, name)) )
+
+    for name in file_names:
+      file_name = op.join(dir_name, name)
+      if file_name not in checksum_of:
+        unique.add(dir_name)
+        break
+      entries[dir_name].append( ('f', name, checksum_of[file_name]) )
+
+  # Subdirectories come after their parent in the walk, so hash in reverse
+  # walk order to have every subdirectory's hash ready.
+  dir_hashes = {}
+  for dir_name in reversed(walk_order):
+    if dir_name in unique:
+      continue
+
+    merkle = hl.md5()
+    for kind, name, value in sorted(entries[dir_name]):
+      if kind == 'd':
+        # Not hashed: unique, unreadable or a link that wasn't followed.
+        if value not in dir_hashes:
+          unique.add(dir_name)
+          break
+        files_below[dir_name] += files_below[value]
+        value = dir_hashes[value]
+      merkle.update( '%s\0%s\0%s\n' % (kind, name, value) )
+    else:
+      # Empty trees are all alike, but there's nothing to report in them.
+      if files_below[dir_name]:
+        dir_hashes[dir_name] = merkle.hexdigest()
+
+  dir_dict = {}
+  for dir_name in walk_order:
+    if dir_name in dir_hashes:
+      if dir_hashes[dir_name] not in dir_dict:
+        dir_dict[dir_hashes[dir_name]] = []
+      dir_dict[dir_hashes[dir_name]].append(dir_name)
+
+  # Settle the shallowest groups first. A directory under one that will be
+  # removed is already covered by it, so it isn't listed again, and a group
+  # left with a single directory has nothing to report.
+  removed = set()
+  depth = lambda key: min( name.count(os.sep) for name in dir_dict[key] )
+  for key in sorted(dir_dict, key=depth):
+    dirs = [name for name in dir_dict[key] if not in_dirs(name, removed)]
+    if len(dirs) > 1:
+      dir_dict[key] = dirs
+      removed.update( dirs[1:] )
+    else:
+      del dir_dict[key]
+
+  return dir_dict
+
+
+def in_dirs( file_name, dirs ):
+  """
+  Returns True if FILE_NAME lies anywhere below one of the directories in the
+  set DIRS.
+  """
+
+  parent = op.dirname(file_name)
+  while parent not in dirs:
+    if parent == op.dirname(parent):
+      return False
+    parent = op.dirname(parent)
+
+  return True
+
+
+def escape_path( path ):
+  """
+  Escapes backslashes and newlines in PATH so it fits on one manifest line.
+  """
+
+  return path.replace('\\', '\\\\').replace('\n', '\\n')
+
+
+def unescape_path( text ):
+  """
+  Reverses escape_path().
+  """
+
+  return re.sub( r'\\(.)',
+                 lambda match: '\n' if match.group(1) == 'n' else match.group(1),
+                 text )
+
+
+def write_manifest( manifest, shard, full_algo, prefilter_algo, entries ):
+  """
+  Writes ENTRIES, tuples of (size, full checksum, partial checksum, mtime,
+  path), to the file MANIFEST sorted by size and full checksum so manifests
+  can be merged as streams. The header records the SHARD name and the
+  algorithms used for the FULL_ALGO and PREFILTER_ALGO checksums.
+  """
+
+  out_file = open(manifest, 'w')
+  out_file.write( '\t'.join([MANIFEST_HEADER, shard, full_algo,
+                              prefilter_algo]) + '\n' )
+
+  for size, full, partial, mtime, path in sorted(entries):
+    out_file.write( '%d\t%s\t%s\t%d\t%s\n' % (size, full, partial, mtime,
+                                               escape_path(path)) )
+  out_file.close()
+
+
+def read_manifest( manifest ):
+  """
+  Returns the (shard, full algorithm, prefilter algorithm) header of the file
+  MANIFEST and a generator of its (size, full checksum, shard, path) entries,
+  which reads the file one line at a time.
+  """
+
+  in_file = open(manifest, 'r')
+  header = in_file.readline().rstrip('\n').split('\t')
+  if len(header) != 4 or header[0] != MANIFEST_HEADER:
+    in_file.close()
+    raise ValueError("%s is not a find_dups manifest" % manifest)
+  shard = header[1]
+
+  def entries():
+    for line in in_file:
+      size, full, partial, mtime, path = line.rstrip('\n').split('\t', 4)
+      yield int(size), full, shard, unescape_path(path)
+    in_file.close()
+
+  return tuple(header[1:]), entries()
+
+
+def merge_manifests( manifests ):
+  """
+  Sort-merges the sorted MANIFESTS and yields each group of two or more
+  entries sharing a size and full checksum, as lists of 'shard:path' names.
+  Only one entry of each manifest and the current group are held in memory.
+  """
+
+  streams = []
+  algos = None
+  for manifest in manifests:
+    header, entries = read_manifest( manifest )
+    if algos is None:
+      algos = header[1:]
+    elif header[1:] != algos:
+      raise ValueError("%s was made with different algorithms" % manifest)
+    streams.append(entries)
+
+  group = []
+  for size, full, shard, path in heapq.merge( *streams ):
+    if group and group[0][:2] != (size, full):
+      if len(group) > 1:
+        yield ['%s:%s' % (entry[2], entry[3]) for entry in group]
+      group = []
+    group.append( (size, full, shard, path) )
+
+  if len(group) > 1:
+    yield ['%s:%s' % (entry[2], entry[3]) for entry in group]
+
+
+def run_merge( args ):
+  """
+  Entry point for the merge subcommand. Reports the duplicates found across
+  the shard manifests given in ARGS.
+  """
+
+  writer = None
+  if args.format:
+    writer = ReportWriter( args.format, args.output )
+
+  try:
+    for group in merge_manifests( args.manifests ):
+      report_duplicates( [(group[0], group[1:])], writer=writer )
+  except (IOError, ValueError) as err:
+    print "Could not merge manifests: %s" % err
+    exit(1)
+
+  if writer:
+    writer.close()
+
+
 def find_duplicates( file_dict ):
   """
   Inpsects the given dictionary for duplicates, returns list of just
@@ -100,16 +1421,354 @@ def find_duplicates( file_dict ):
   return all_dups
 
 
-def report_duplicates( duplicates, script=None ):
+def link_file( original, duplicate, method='hard' ):
+  """
+  Replaces DUPLICATE with a hardlink (METHOD 'hard') or a reflink (METHOD
+  'reflink') to ORIGINAL. The link is made under a temporary name and renamed
+  over DUPLICATE, so a crash leaves either the old file or the new link.
+  """
+
+  temp_name = op.join( op.dirname(duplicate),
+                       '.%s.find_dups' % op.basename(duplicate) )
+
+  try:
+    if method == 'hard':
+      os.link( original, temp_name )
+    else:
+      if fcntl is None:
+        raise OSError(errno.ENOTSUP, "Reflinks are not supported here")
+
+      src = open(original, 'rb')
+      dst = open(temp_name, 'wb')
+      try:
+        fcntl.ioctl( dst.fileno(), FICLONE, src.fileno() )
+      finally:
+        dst.close()
+        src.close()
+
+      # A reflink is a new file, so keep the duplicate's mode and times.
+      shutil.copystat( duplicate, temp_name )
+
+    os.rename( temp_name, duplicate )
+  except (IOError, OSError):
+    if op.lexists(temp_name):
+      os.remove(temp_name)
+    raise
+
+
+def link_duplicates( duplicates, method='hard' ):
+  """
+  Replaces every duplicate in DUPLICATES with a link to its original, using
+  link_file(). Returns the number of bytes reclaimed. A duplicate whose
+  inode has other names frees nothing, those names still hold the data.
+  """
+
+  reclaimed = 0
+
+  for original, file_dups in duplicates:
+    for file_name in file_dups:
+      try:
+        st = os.lstat( file_name )
+        size = st.st_size if st.st_nlink == 1 else 0
+        link_file( original, file_name, method )
+      except (IOError, OSError) as err:
+        print "Could not link %s: %s" % (file_name, err)
+        continue
+      reclaimed += size
+
+  return reclaimed
+
+
+class Checkpoint(object):
+  """
+  Progress of a scan kept in STATE_FILE: the settings it was started with,
+  the files found by the walk, the checksums computed so far and the files
+  still waiting to be hashed. The state is saved every INTERVAL seconds and on
+  SIGINT so an interrupted scan can be continued with --resume.
+  """
+
+  def __init__( self, state_file, interval=CHECKPOINT_INTERVAL ):
+    self.state_file = state_file
+    self.interval = interval
+    self.last_save = time.time()
+    self.pending = set()
+    self.state = {'settings': None, 'files': None, 'partial': {}, 'full': {},
+                  'pending': []}
+
+  def load( self ):
+    in_file = open(self.state_file, 'rb')
+    self.state = pickle.load(in_file)
+    in_file.close()
+
+  def save( self ):
+    """
+    Writes the state under a temporary name and renames it over STATE_FILE,
+    so an interruption while saving never leaves a truncated checkpoint.
+    """
+
+    state_dir = op.dirname(self.state_file)
+    if state_dir and not op.isdir(state_dir):
+      os.makedirs(state_dir)
+
+    self.state['pending'] = list(self.pending)
+    temp_name = self.state_file + '.tmp'
+    out_file = open(temp_name, 'wb')
+    pickle.dump(self.state, out_file, pickle.HIGHEST_PROTOCOL)
+    out_file.close()
+    os.rename( temp_name, self.state_file )
+    self.last_save = time.time()
+
+  def remove( self ):
+    if op.exists(self.state_file):
+      os.remove(self.state_file)
+
+  def hasher( self, column, hasher ):
+    """
+    Wraps HASHER so files with a COLUMN checksum already in the checkpoint
+    aren't hashed again, and new checksums are recorded as they arrive. Each
+    checksum is kept as a binary digest, half the size of a hex string,
+    along with the stat key of the file when it was hashed. A file whose
+    stat key has changed since is hashed again, like a stale cache entry.
+    """
+
+    done = self.state[column]
+
+    def checkpointed( file_names ):
+      keys = {}
+      saved = []
+      self.pending = set()
+      for file_name in file_names:
+        try:
+          keys[file_name] = stat_key( os.stat(file_name) )
+        except OSError:
+          keys[file_name] = None
+
+        entry = done.get(file_name)
+        if entry and keys[file_name] is not None and entry[0] == keys[file_name]:
+          saved.append( (file_name, hexlify(entry[1])) )
+        else:
+          self.pending.add(file_name)
+
+      for file_name, chksum in saved:
+        yield file_name, chksum
+
+      for file_name, chksum in hasher( list(self.pending) ):
+        if chksum is not None and keys[file_name] is not None:
+          done[file_name] = (keys[file_name], unhexlify( chksum ))
+        self.pending.discard(file_name)
+
+        if time.time() - self.last_save >= self.interval:
+          self.save()
+        yield file_name, chksum
+
+    return checkpointed
+
+
+def json_path( path ):
+  """
+  Returns PATH ready for json.dumps(). Names that aren't valid UTF-8 are
+  decoded as Latin-1 instead, so one odd name can't stop a report.
+  """
+
+  if isinstance(path, bytes):
+    try:
+      return path.decode('utf-8')
+    except UnicodeDecodeError:
+      return path.decode('latin-1')
+  return path
+
+
+class ReportWriter(object):
+  """
+  Writes groups of duplicates to the file OUTPUT (stdout if not given) as JSON
+  Lines or CSV. Each group is flushed as it's written so other tools can read
+  the report while the scan is still running.
+  """
+
+  formats = ('jsonl', 'csv')
+
+  def __init__( self, fmt, output=None ):
+    if fmt not in self.formats:
+      raise ValueError("Unknown report format: %s" % fmt)
+
+    if output:
+      self.out = open(output, 'wb' if fmt == 'csv' else 'w')
+    else:
+      self.out = sys.stdout
+
+    self.fmt = fmt
+    self.group = 0
+    if fmt == 'csv':
+      self.csv = csv.writer(self.out)
+      self.csv.writerow( ['group', 'role', 'path'] )
+
+  def write( self, original, duplicates ):
+    """
+    Writes one group made of ORIGINAL and its list of DUPLICATES.
+    """
+
+    self.group += 1
+    if self.fmt == 'jsonl':
+      record = {'group': self.group, 'original': json_path(original),
+                'duplicates': [json_path(name) for name in duplicates]}
+      self.out.write( json.dumps(record, sort_keys=True) + '\n' )
+    else:
+      self.csv.writerow( [self.group, 'original', original] )
+      for file_name in duplicates:
+        self.csv.writerow( [self.group, 'duplicate', file_name] )
+
+    self.out.flush()
+
+  def close( self ):
+    if self.out is not sys.stdout:
+      self.out.close()
+
+
+def tree_entries( dir_name ):
+  """
+  Returns a dictionary of every file and subdirectory below DIR_NAME, by its
+  path relative to DIR_NAME, to its size (None for directories), and the
+  bytes that removing the tree would free, i.e. the sizes of the files that
+  have no other links. Raises OSError if part of the tree can't be read.
+  """
+
+  def fail( err ):
+    raise err
+
+  entries = {}
+  freed = 0
+  for parent, sub_dirs, file_names in os.walk( dir_name, onerror=fail ):
+    rel = op.relpath( parent, dir_name )
+    for name in sub_dirs:
+      entries[op.normpath(op.join(rel, name))] = None
+    for name in file_names:
+      st = os.lstat( op.join(parent, name) )
+      entries[op.normpath(op.join(rel, name))] = st.st_size
+      if st.st_nlink == 1:
+        freed += st.st_size
+
+  return entries, freed
+
+
+def delete_batch( batch ):
+  """
+  Removes each (duplicate, original) pair in BATCH whose original still
+  exists. A duplicate directory is only removed while it still holds the
+  same names and sizes as its original, the contents having been compared
+  when the two were matched. Returns the list of (duplicate, original,
+  bytes freed) that were removed and the list of (duplicate, error) that
+  couldn't be.
+  """
+
+  removed = []
+  errors = []
+
+  for file_name, original in batch:
+    # Never remove the last copy.
+    if not op.exists(original):
+      errors.append( (file_name, "original %s is missing" % original) )
+      continue
+
+    try:
+      if op.isdir(file_name) and not op.islink(file_name):
+        entries, size = tree_entries( file_name )
+        if entries != tree_entries( original )[0]:
+          errors.append( (file_name, "contents no longer match %s" % original) )
+          continue
+        shutil.rmtree(file_name)
+      else:
+        # Other links keep the data, only the last one frees it.
+        st = os.lstat(file_name)
+        size = st.st_size if st.st_nlink == 1 else 0
+        os.unlink(file_name)
+    except (IOError, OSError) as err:
+      errors.append( (file_name, err) )
+      continue
+    removed.append( (file_name, original, size) )
+
+  return removed, errors
+
+
+def sync_dirs( dir_names ):
   """
-  Outputs the given list of duplicates either to the display or to a removal
-  script if SCRIPT is specified.
+  Flushes the entries of each directory in DIR_NAMES to disk, so completed
+  deletions survive a crash. Platforms that can't open directories are
+  skipped.
+  """
+
+  for dir_name in dir_names:
+    try:
+      fd = os.open( dir_name, os.O_RDONLY )
+    except OSError:
+      continue
+    try:
+      os.fsync(fd)
+    except OSError:
+      pass
+    finally:
+      os.close(fd)
+
+
+def delete_duplicates( duplicates, jobs=4, journal=JOURNAL_FILE,
+                       dry_run=False ):
+  """
+  Removes every duplicate in DUPLICATES in batches of DELETE_BATCH spread
+  over JOBS threads, recording each removal with its original in the file
+  JOURNAL as it happens. With DRY_RUN nothing is removed, the duplicates are
+  only listed. Returns the number of duplicates removed and the bytes freed.
+  """
+
+  pairs = [(file_name, original) for original, file_dups in duplicates
+                                 for file_name in file_dups]
+
+  if dry_run:
+    for file_name, original in pairs:
+      print "Would remove %s (original: %s)" % (file_name, original)
+    return 0, 0
+
+  batches = [pairs[index:index + DELETE_BATCH]
+             for index in range(0, len(pairs), DELETE_BATCH)]
+
+  count = 0
+  total = 0
+  dir_names = set()
+  log = open(journal, 'a')
+  pool = ThreadPool(max(jobs, 1))
+  try:
+    for removed, errors in pool.imap_unordered( delete_batch, batches ):
+      for file_name, original, size in removed:
+        log.write( '%s\t%s\n' % (escape_path(file_name),
+                                   escape_path(original)) )
+        dir_names.add( op.dirname(op.abspath(file_name)) )
+        count += 1
+        total += size
+      log.flush()
+
+      for file_name, err in errors:
+        print "Could not remove %s: %s" % (file_name, err)
+  finally:
+    pool.terminate()
+    log.close()
+
+  sync_dirs( dir_names )
+  return count, total
+
+
+def report_duplicates( duplicates, script=None, writer=None ):
+  """
+  Outputs the given list of duplicates either to the display, to a removal
+  script if SCRIPT is specified or to the ReportWriter WRITER.
   """
 
   # Bail out if there were no duplicates
   if not duplicates:
     return
 
+  if writer:
+    for original, file_dups in duplicates:
+      writer.write( original, file_dups )
+    return
+
   # Structure of a 'duplicates' list element:
   # ( original file, duplicates[] )
 
@@ -124,7 +1783,10 @@ def report_duplicates( duplicates, script=None ):
       script.write('# Original: %s\n' % duplicate[0] )
 
       for file_name in duplicate[1]:
-        script.write('rm "%s"\n' % file_name)
+        if op.isdir(file_name):
+          script.write('rm -r "%s"\n' % file_name)
+        else:
+          script.write('rm "%s"\n' % file_name)
       script.write('\n')
 
     script.close()
@@ -147,6 +1809,10 @@ def run( args ):
 
   file_dict = {}
 
+  if args.benchmark:
+    benchmark_algorithms()
+    return
+
   # If not specified, assume current dir for search
   if args.path:
     path = args.path
@@ -166,26 +1832,294 @@ def run( args ):
   else:
     kind = "pics"
 
-  # Get the list of files rooted at the input directory
-  file_list = find_files(path, kind)
+  if args.block_size:
+    block_size = args.block_size * 1024
+  else:
+    block_size = BLOCK_SIZE
 
-  # Generate the checksums of the files
-  for file_name in file_list:
-    chksum = gen_checksum( file_name )
+  jobs = args.jobs or 1
+  device_jobs = args.device_jobs or 0
+
+  algo = args.algo or 'md5'
+  prefilter_algo = args.prefilter_algo or FAST_ALGO
+
+  # Reject conflicting options before anything is walked or saved.
+  if args.dirs and (args.link or args.similar is not None):
+    print "Duplicate directories can't be used with --link or --similar!"
+    exit(1)
+
+  if args.similar is not None and (args.checkpoint or args.resume):
+    print "Checkpoints are only kept for checksum scans, not --similar!"
+    exit(1)
+
+  if args.audio and (kind != 'songs' or args.sample or args.similar is not None):
+    print "Audio matching is only available for songs, without --sample!"
+    exit(1)
+
+  if args.format and args.link:
+    print "A report format can't be used with --link!"
+    exit(1)
+
+  if args.delete and (args.link or args.format or args.script):
+    print "--delete can't be used with --link, --format or --script!"
+    exit(1)
+
+  if args.similar is not None and kind != 'pics':
+    print "Similar matching is only available for pics!"
+    exit(1)
+
+  if args.similar is not None and Image is None:
+    print "Similar matching requires PIL (pip install Pillow)!"
+    exit(1)
+
+  # The walk and every checksum are saved as the scan goes if requested.
+  global active_checkpoint
+  checkpoint = None
+  if args.checkpoint or args.resume:
+    checkpoint = Checkpoint( args.checkpoint or CHECKPOINT_FILE,
+                             args.checkpoint_interval or CHECKPOINT_INTERVAL )
+    settings = (op.abspath(path), kind, prefilter_algo, algo, args.sample,
+                args.audio)
+
+  if args.resume:
+    try:
+      checkpoint.load()
+    except (IOError, EOFError, pickle.UnpicklingError) as err:
+      print "Could not load checkpoint %s: %s" % (checkpoint.state_file, err)
+      exit(1)
+
+    if checkpoint.state['settings'] != settings:
+      print "Checkpoint was saved for a different path, kind or algorithm!"
+      exit(1)
+    file_list = checkpoint.state['files']
+  else:
+    # Get the list of files rooted at the input directory
+    file_list = find_files(path, kind)
+
+    if checkpoint:
+      checkpoint.state['settings'] = settings
+      checkpoint.state['files'] = file_list
+      checkpoint.save()
+
+  active_checkpoint = checkpoint
+
+  if args.memory_benchmark:
+    benchmark_memory( file_list )
+    return
+
+  if args.schedule_benchmark:
+    benchmark_schedule( file_list, args.schedule or 'inode', block_size )
+    return
+
+  writer = None
+  if args.format:
+    writer = ReportWriter( args.format, args.output )
+
+  # Similar images don't share a checksum, so compare what they look like.
+  if args.similar is not None:
+    # Drop extra names of the same inode, just as the checksum path does.
+    size_dict = group_by_size( file_list )
+    unique = sorted( index for size in size_dict for index in size_dict[size] )
+    file_list = [file_list[index] for index in unique]
+
+    file_dict = find_similar( file_list, args.similar, jobs, device_jobs )
+    report_duplicates( find_duplicates(file_dict), args.script, writer )
+    if writer:
+      writer.close()
+    return
+
+  # Unchanged files are looked up in the cache rather than read again.
+  cache = None
+  if not args.no_cache:
+    cache = HashCache( args.cache or CACHE_FILE )
+
+  # Songs are compared on their audio frames alone, so copies that only
+  # differ in their tags still match.
+  region = None
+  prefilter_tag = prefilter_algo
+  if args.audio:
+    regions = {}
+    def region( file_name ):
+      if file_name not in regions:
+        regions[file_name] = audio_region( file_name )
+      return regions[file_name]
+    prefilter_tag = 'audio-' + prefilter_algo
+
+  partial_checksum = lambda name: gen_partial_checksum(
+                                    name, algo=prefilter_algo,
+                                    region=region and region(name) )
+  # Read files in the order they sit on disk instead of walk order.
+  schedule = lambda names: names
+  if args.schedule:
+    schedule = lambda names: disk_order( names, args.schedule )
 
-    if chksum not in file_dict:
-      file_dict[chksum] = []
-    file_dict[chksum].append(file_name)
+  partial_hasher = lambda names: hash_files( schedule(names),
+                                             partial_checksum, 'partial',
+                                             prefilter_tag, cache, jobs,
+                                             device_jobs )
+  # A sampled fingerprint stands in for the full checksum, --verify can then
+  # confirm just the groups it matches.
+  full_algo = algo
+  if args.audio:
+    full_checksum = lambda name: gen_checksum( name, block_size, algo,
+                                               region(name) )
+    full_algo = 'audio-' + algo
+  elif args.sample:
+    full_checksum = lambda name: gen_sample_checksum( name, args.sample,
+                                                      algo=algo )
+    full_algo = 'sample%d-%s' % (args.sample, algo)
+  elif args.mmap:
+    full_checksum = lambda name: gen_mmap_checksum( name, block_size, algo )
+  else:
+    full_checksum = lambda name: gen_checksum( name, block_size, algo )
+  full_hasher = lambda names: hash_files( schedule(names), full_checksum,
+                                          'full', full_algo, cache, jobs,
+                                          device_jobs )
+
+  if checkpoint:
+    partial_hasher = checkpoint.hasher( 'partial', partial_hasher )
+    full_hasher = checkpoint.hasher( 'full', full_hasher )
+
+  # A twin of any file may sit in another shard, so a manifest needs the
+  # checksums of every file rather than just those sharing a size here.
+  if args.manifest:
+    size_dict = group_by_size( file_list, region )
+    size_of = {}
+    for size in size_dict:
+      for index in size_dict[size]:
+        size_of[file_list[index]] = size
+    size_dict = None
+
+    names = list(size_of)
+    partial = dict( partial_hasher(names) )
+    full = dict( full_hasher(names) )
+
+    entries = []
+    for file_name in names:
+      if not partial.get(file_name) or not full.get(file_name):
+        continue
+      try:
+        mtime = stat_key( os.stat(file_name) )[3]
+      except OSError:
+        continue
+      # Merged reports name files by shard, so they must be found from any
+      # directory on it.
+      entries.append( (size_of[file_name], full[file_name],
+                       partial[file_name], mtime, op.abspath(file_name)) )
+
+    write_manifest( args.manifest, args.shard or socket.gethostname(),
+                    full_algo, prefilter_tag, entries )
+
+    if cache:
+      cache.close()
+    if checkpoint:
+      active_checkpoint = None
+      checkpoint.remove()
+    return
+
+  # Only files sharing a size can be duplicates, so the rest are never read.
+  size_dict = group_by_size( file_list, region )
+  groups = [[file_list[index] for index in size_dict[size]]
+            for size in size_dict if len(size_dict[size]) > 1]
+  size_dict = None
+
+  # Hash the head and tail of the remaining files, then fully hash only the
+  # files that still collide.
+  candidates = find_candidates( groups, partial_hasher )
+
+  # Groups are written out as soon as they're confirmed, unless they're
+  # needed for the directory report first.
+  stream = writer is not None and not args.dirs
+
+  # Workers finish in any order, keep the walk order so the file reported as
+  # the original doesn't change from run to run. Groups are already in walk
+  # order, and only files within a group are ever compared.
+  order = {}
+  for group in groups:
+    for file_name in group:
+      order[file_name] = len(order)
+  groups = None
+
+  for chksum, group in confirm_groups( candidates, full_hasher ):
+    scan_stats.add('groups_confirmed')
+    group.sort( key=order.get )
+
+    if stream:
+      found = {chksum: group}
+      if args.verify:
+        found = verify_groups( found, args.verify, block_size,
+                               region=region )
+      report_duplicates( find_duplicates(found), writer=writer )
+    else:
+      file_dict[chksum] = group
+
+  # Confirm the groups with a strong hash or a byte compare if requested.
+  if args.verify and not stream:
+    file_dict = verify_groups( file_dict, args.verify, block_size, jobs,
+                               device_jobs, region )
+
+  if cache:
+    cache.prune( path )
+    cache.close()
+
+  # Every file is hashed, there's nothing left to resume.
+  if checkpoint:
+    active_checkpoint = None
+    checkpoint.remove()
+
+  # Report whole duplicated directories once, and leave their files out of
+  # the file level report.
+  dir_dups = []
+  if args.dirs:
+    dir_dups = find_duplicates( find_duplicate_dirs(path, file_dict) )
+    covered = set( name for original, dups in dir_dups for name in dups )
+    for chksum in file_dict:
+      file_dict[chksum] = [name for name in file_dict[chksum]
+                                if not in_dirs(name, covered)]
 
   # Create the list of duplicates
-  duplicates = find_duplicates( file_dict )
+  duplicates = dir_dups + find_duplicates( file_dict )
+
+  # Report on the duplicates, or replace them with links to the originals,
+  # or remove them.
+  if args.link:
+    reclaimed = link_duplicates( duplicates, args.link )
+    print "Reclaimed %d bytes" % reclaimed
+  elif args.delete:
+    count, reclaimed = delete_duplicates( duplicates, args.jobs or 4,
+                                          args.journal or JOURNAL_FILE,
+                                          args.dry_run )
+    if not args.dry_run:
+      print "Removed %d duplicates, reclaimed %d bytes" % (count, reclaimed)
+  else:
+    report_duplicates( duplicates, args.script, writer )
 
-  # Report on the duplicates
-  report_duplicates( duplicates, args.script )
+  if writer:
+    writer.close()
+
+
+def write_stats( stats_file ):
+  """
+  Writes the final scan counters to STATS_FILE as JSON, or to stderr if
+  STATS_FILE is '-'.
+  """
+
+  summary = json.dumps( scan_stats.summary(), sort_keys=True )
+  if stats_file == '-':
+    sys.stderr.write( summary + '\n' )
+  else:
+    out_file = open(stats_file, 'w')
+    out_file.write( summary + '\n' )
+    out_file.close()
 
 
 def handle_sigint(sig_num, frame):
 
+  if active_checkpoint:
+    active_checkpoint.save()
+    print("\nProgress saved to %s, continue with --resume"
+          % active_checkpoint.state_file)
+
   print("\nQuitting...")
   exit(0)
 
@@ -198,10 +2132,115 @@ if __name__ == "__main__":
   argument is set, create a script file (rmscript.sh) that can be run to delete duplicates.
   """
 
+  # The merge subcommand joins the manifests of separately scanned shards.
+  if len(sys.argv) > 1 and sys.argv[1] == 'merge':
+    parser = ap.ArgumentParser(prog="%s merge" % sys.argv[0],
+                               description="Find duplicates across the "
+                                           "manifests of several shards.")
+    parser.add_argument("manifests", nargs="+", help="Shard manifest files")
+    parser.add_argument("-f", "--format", choices=ReportWriter.formats,
+                        help="Write each duplicate group in this format")
+    parser.add_argument("-o", "--output",
+                        help="File for the --format report (default: stdout)")
+    run_merge( parser.parse_args(sys.argv[2:]) )
+    exit(0)
+
   parser = ap.ArgumentParser(description=desc_str)
   parser.add_argument("-p", "--path", help="Root directory of the search")
   parser.add_argument("-k", "--kind", help="Kind of files to inspect (pics, movies, songs)")
   parser.add_argument("-s", "--script", action="store_true",
                       help="Creates a removal script if specified")
+  parser.add_argument("-b", "--block-size", type=int,
+                      help="Size in KB of the read buffer used for hashing")
+  parser.add_argument("-c", "--cache",
+                      help="Checksum cache database (default: %s)" % CACHE_FILE)
+  parser.add_argument("--no-cache", action="store_true",
+                      help="Don't read or update the checksum cache")
+  parser.add_argument("-j", "--jobs", type=int,
+                      help="Number of files to hash in parallel")
+  parser.add_argument("--device-jobs", type=int,
+                      help="Maximum number of files read at once per device")
+  parser.add_argument("-m", "--mmap", action="store_true",
+                      help="Hash large files through a memory map")
+  parser.add_argument("--sample", type=int, metavar="N",
+                      help="Match files on their size and N %d KB samples "
+                           "instead of a full checksum, use --verify to "
+                           "confirm the matches" % (SAMPLE_SIZE // 1024))
+  parser.add_argument("--audio", action="store_true",
+                      help="Compare songs on their audio frames only, ignoring "
+                           "ID3 and APE tags")
+  parser.add_argument("-a", "--algo", choices=sorted(ALGORITHMS),
+                      help="Algorithm for the full checksum (default: md5)")
+  parser.add_argument("--prefilter-algo", choices=sorted(ALGORITHMS),
+                      help="Algorithm for the partial checksum (default: %s)"
+                           % FAST_ALGO)
+  parser.add_argument("--verify", choices=['hash', 'bytes'],
+                      help="Confirm duplicates with a %s hash or a byte compare"
+                           % STRONG_ALGO)
+  parser.add_argument("--similar", type=int, metavar="BITS",
+                      help="Report pics whose perceptual hashes differ by at "
+                           "most BITS of 64, instead of identical files")
+  parser.add_argument("-l", "--link", choices=['hard', 'reflink'],
+                      help="Replace duplicates with hardlinks or reflinks to "
+                           "the original instead of reporting them. Other "
+                           "hardlink names of a duplicate are not relinked")
+  parser.add_argument("--delete", action="store_true",
+                      help="Remove the duplicates instead of reporting them")
+  parser.add_argument("-n", "--dry-run", action="store_true",
+                      help="With --delete, list what would be removed")
+  parser.add_argument("--journal",
+                      help="File --delete records removals in (default: %s)"
+                           % JOURNAL_FILE)
+  parser.add_argument("-d", "--dirs", action="store_true",
+                      help="Report whole duplicated directories once instead "
+                           "of every file inside them")
+  parser.add_argument("-f", "--format", choices=ReportWriter.formats,
+                      help="Stream each duplicate group as it's confirmed in "
+                           "this format")
+  parser.add_argument("-o", "--output",
+                      help="File for the --format report (default: stdout)")
+  parser.add_argument("--checkpoint", nargs="?", const=CHECKPOINT_FILE,
+                      metavar="FILE",
+                      help="Save scan progress to FILE (default: %s)"
+                           % CHECKPOINT_FILE)
+  parser.add_argument("--checkpoint-interval", type=int, metavar="SECONDS",
+                      help="Seconds between checkpoint saves (default: %d)"
+                           % CHECKPOINT_INTERVAL)
+  parser.add_argument("-r", "--resume", action="store_true",
+                      help="Continue the scan saved in the checkpoint")
+  parser.add_argument("--schedule", choices=['inode', 'extent'],
+                      help="Read files in inode or physical extent order to "
+                           "cut seeking on spinning disks")
+  parser.add_argument("--schedule-benchmark", action="store_true",
+                      help="Report the MB/s of reading the files in walk order "
+                           "and in --schedule order, and exit")
+  parser.add_argument("--memory-benchmark", action="store_true",
+                      help="Report the bytes used per file to track the scan, "
+                           "and exit")
+  parser.add_argument("--manifest", metavar="FILE",
+                      help="Write the checksums of every file to a shard "
+                           "manifest instead of reporting, for '%(prog)s merge'")
+  parser.add_argument("--shard",
+                      help="Name of this shard in the manifest (default: the "
+                           "host name)")
+  parser.add_argument("--progress", nargs="?", type=float, const=5.0,
+                      metavar="SECONDS",
+                      help="Print a progress line to stderr every SECONDS "
+                           "(default: 5)")
+  parser.add_argument("--stats", metavar="FILE",
+                      help="Write the final scan counters as JSON to FILE, "
+                           "or to stderr for '-'")
+  parser.add_argument("--benchmark", action="store_true",
+                      help="Report the MB/s of each hash algorithm and exit")
   args = parser.parse_args()
+
+  progress = None
+  if args.progress:
+    progress = scan_stats.report_every( args.progress )
+
   run( args )
+
+  if progress:
+    progress.set()
+  if args.stats:
+    write_stats( args.stats )